@@ -0,0 +1,361 @@
+import json
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from capture import SyntheticSource
+from engine import AsyncEngine
+from frames import TileCache, apply_tiles, available_codecs
+from inputs import InputSink
+from metrics import Histogram
+from protocol import Channel, PROTOCOLS
+from service import server_context
+
+# Higher is worse for every compared metric except fps
+METRICS = {'fps': -1, 'bytes_per_frame': 1, 'cpu_ms_per_frame': 1, 'cpu_percent': 1, 'frame_p50_ms': 1, 'input_p50_ms': 1,
+           'input_p99_ms': 1}
+
+def make_certs(directory):
+    # Throwaway CA, server and client certificates, following cert_gen.txt without the prompts
+    def openssl(*args):
+        subprocess.run(['openssl', *args], cwd=directory, check=True, capture_output=True)
+    
+    openssl('genrsa', '-out', 'rootCA.key', '4096')
+    openssl('req', '-x509', '-new', '-nodes', '-key', 'rootCA.key', '-sha256', '-days', '1024',
+            '-out', 'rootCA.crt', '-subj', '/CN=Benchmark Root CA')
+    for name in ('server', 'client'):
+        openssl('genrsa', '-out', f'{name}.key', '2048')
+        openssl('req', '-new', '-key', f'{name}.key', '-out', f'{name}.csr', '-subj', f'/CN=benchmark-{name}')
+        openssl('x509', '-req', '-in', f'{name}.csr', '-CA', 'rootCA.crt', '-CAkey', 'rootCA.key',
+                '-CAcreateserial', '-out', f'{name}.crt', '-days', '500', '-sha256')
+        openssl('verify', '-CAfile', 'rootCA.crt', f'{name}.crt')
+    return directory
+
+def client_context(certs):
+    # Same settings as SecureClient.setup_ssl
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    context.load_cert_chain(certfile=os.path.join(certs, 'client.crt'), keyfile=os.path.join(certs, 'client.key'))
+    context.load_verify_locations(cafile=os.path.join(certs, 'rootCA.crt'))
+    context.check_hostname = False
+    return context
+
+class RecordingSink(InputSink):
+    # Stands in for the desktop input backend; moves carry their sequence number in x
+    name = 'recording'
+    
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.injected = {}  # Sequence -> perf_counter when injected
+    
+    def mouse(self, data):
+        now = time.perf_counter()
+        if data['type'] == 'move':
+            with self.lock:
+                self.injected[data['x']] = now
+    
+    def key(self, data):
+        pass
+
+class BenchmarkClient:
+    # The receive side of SecureClient without Tk: frames are decoded exactly as the client does
+    def __init__(self, context, port, protocol, codec, quality, fps, input_interval, adaptive=False, link_rate=None,
+                 tile_cache=0):
+        self.protocol = protocol
+        self.codec = codec
+        self.quality = quality
+        self.fps = fps
+        self.input_interval = input_interval
+        self.adaptive = adaptive
+        self.link_rate = link_rate  # Bytes per second the receiver reads at, to emulate a slow link
+        self.rate = None  # Newest rate control decision
+        self.tile_cache = TileCache(tile_cache) if tile_cache else None
+        sock = socket.create_connection(('127.0.0.1', port))
+        self.conn = context.wrap_socket(sock, server_hostname='127.0.0.1')
+        self.channel = Channel(self.conn)
+        self.running = False
+        self.framebuffer = None
+        self.keyframe = threading.Event()
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.bytes = 0
+        self.frame_latency = Histogram()  # Capture to decoded; server and client share a clock here
+        self.stats = None
+        self.stats_received = threading.Event()
+        self.sent = {}  # Sequence -> perf_counter when sent
+    
+    def start(self):
+        message, _ = self.channel.recv()
+        if not message or message['type'] != 'hello':
+            raise RuntimeError("Server did not send a hello")
+        if self.codec not in message['codecs']:
+            raise RuntimeError(f"Server cannot encode {self.codec}")
+        self.channel.negotiate(self.protocol)
+        tile_cache = {'max_bytes': self.tile_cache.max_bytes, 'epoch': 0} if self.tile_cache else None
+        self.channel.send({'type': 'subscribe', 'fps': self.fps, 'codec': self.codec, 'quality': self.quality,
+                           'keyframe': True, 'adaptive': self.adaptive, 'tile_cache': tile_cache})
+        self.running = True
+        self.threads = [threading.Thread(target=target, daemon=True) for target in (self.receive_loop, self.input_loop)]
+        for thread in self.threads:
+            thread.start()
+    
+    def receive_loop(self):
+        # Reads until the server hangs up, so frames still in flight never meet a closed socket
+        try:
+            while True:
+                message, payload = self.channel.recv()
+                if not message:
+                    break
+                if message['type'] == 'stats':
+                    self.stats = message
+                    self.stats_received.set()
+                    continue
+                if message['type'] != 'frame':
+                    continue
+                try:
+                    self.framebuffer = apply_tiles(self.framebuffer, message, payload, self.tile_cache)
+                finally:
+                    self.channel.release(payload)
+                if self.link_rate:
+                    # Not reading lets TCP back up, as a slow link would
+                    time.sleep(message['bytes'] / self.link_rate)
+                if 'frame_id' in message and self.running:
+                    self.rate = message['rate']
+                    self.channel.send({'type': 'frame_ack', 'id': message['frame_id']})
+                with self.lock:
+                    self.frames += 1
+                    self.bytes += message['bytes']
+                    self.frame_latency.add(time.time() - message['captured'])
+                if message['keyframe']:
+                    self.keyframe.set()
+        except Exception as e:
+            if self.running:
+                print(f"Error receiving frames: {e}")
+    
+    def input_loop(self):
+        sequence = 0
+        while self.running:
+            events = []
+            for _ in range(4):
+                events.append({'type': 'mouse', 'data': {'type': 'move', 'x': sequence, 'y': 0}})
+                self.sent[sequence] = time.perf_counter()
+                sequence += 1
+            try:
+                self.channel.send({'type': 'batch', 'events': events})
+            except Exception:
+                break
+            time.sleep(self.input_interval)
+    
+    def counters(self, reset_latency=False):
+        with self.lock:
+            if reset_latency:
+                self.frame_latency = Histogram()
+            return self.frames, self.bytes
+    
+    def request_stats(self, timeout=5.0):
+        self.stats_received.clear()
+        self.channel.send({'type': 'stats'})
+        self.stats_received.wait(timeout)
+        return (self.stats or {}).get('stages', {})
+    
+    def stop_input(self):
+        self.running = False
+        self.threads[1].join(5)
+    
+    def close(self):
+        self.running = False
+        self.threads[0].join(5)
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+def run_case(certs, mode, codec, protocol, duration=5.0, width=1920, height=1080, fps=30, quality=85,
+             encode_workers=None, input_interval=0.01, adaptive=False, link_rate=None, tile_cache=0):
+    sink = RecordingSink()
+    source = SyntheticSource(width, height, mode=mode)
+    engine = AsyncEngine(server_context(certs), source, sink.inject, lambda path: False,
+                         host='127.0.0.1', port=0, encode_workers=encode_workers)
+    engine.start()
+    engine.ready.wait(10)
+    client = BenchmarkClient(client_context(certs), engine.port, protocol, codec, quality, fps, input_interval,
+                             adaptive, link_rate, tile_cache)
+    try:
+        client.start()
+        if not client.keyframe.wait(30):
+            raise RuntimeError("No keyframe received")
+        
+        # Server and client share this process, so CPU time covers both ends of the stream
+        frames, received = client.counters(reset_latency=True)
+        cpu = time.process_time()
+        started = time.perf_counter()
+        measured_from = len(client.sent)
+        time.sleep(duration)
+        elapsed = time.perf_counter() - started
+        cpu = time.process_time() - cpu
+        frames, received = (now - before for now, before in zip(client.counters(), (frames, received)))
+        stages = client.request_stats()
+    finally:
+        # Stop sending first and let the server hang up, so neither side logs a reset
+        client.stop_input()
+        engine.stop()
+        client.close()
+        engine.thread.join(10)
+    
+    latency = Histogram()
+    with sink.lock:
+        injected = dict(sink.injected)
+    for sequence, sent_at in list(client.sent.items())[measured_from:]:
+        if sequence in injected:
+            latency.add(injected[sequence] - sent_at)
+    
+    return {
+        'mode': mode,
+        'codec': codec,
+        'protocol': protocol,
+        'frames': frames,
+        'fps': frames / elapsed,
+        'bytes_per_frame': received / frames if frames else 0.0,
+        'cpu_ms_per_frame': cpu / frames * 1000 if frames else 0.0,
+        'cpu_percent': cpu / elapsed * 100,  # Still meaningful when a static screen sends no frames
+        'frame_p50_ms': client.frame_latency.percentile(0.5) * 1000,
+        'frame_p99_ms': client.frame_latency.percentile(0.99) * 1000,
+        'input_events': latency.count,
+        'input_p50_ms': latency.percentile(0.5) * 1000,
+        'input_p99_ms': latency.percentile(0.99) * 1000,
+        'encode_p50_ms': stages.get('encode', {}).get('p50_ms', 0.0),
+        'rate': client.rate,
+        'tile_cache': (client.stats or {}).get('tile_cache')  # Whole run, the keyframe included
+    }
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def measure_startup(certs, command, port, timeout=30.0):
+    # Time from launching the server process until it completes its first mutual-TLS handshake
+    context = client_context(certs)
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=certs, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with socket.create_connection(('127.0.0.1', port), timeout=1.0) as sock:
+                    with context.wrap_socket(sock, server_hostname='127.0.0.1'):
+                        return {'accept_ms': (time.perf_counter() - started) * 1000}
+            except (OSError, ssl.SSLError):
+                if process.poll() is not None:
+                    lines = process.stderr.read().decode(errors='replace').strip().splitlines()
+                    return {'error': lines[-1] if lines else f"exited with code {process.returncode}"}
+                time.sleep(0.005)
+        return {'error': f"no accept within {timeout:g}s"}
+    finally:
+        process.terminate()
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def startup_commands(certs, port):
+    here = os.path.dirname(os.path.abspath(__file__))
+    return {
+        'headless': [sys.executable, os.path.join(here, 'service.py'), '--port', str(port), '--certs', certs,
+                     '--host', '127.0.0.1', '--no-tunnel'],
+        'gui': [sys.executable, os.path.join(here, 'server.py'), '--port', str(port), '--start']
+    }
+
+def case_key(result):
+    return result['mode'], result['codec'], result['protocol']
+
+def compare(results, baseline, threshold=0.1):
+    # Returns (case, metric, baseline value, new value) for every metric that got worse than the threshold
+    previous = {case_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(case_key(result))
+        if before is None:
+            continue
+        for metric, direction in METRICS.items():
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            if (new - old) / old * direction > threshold:
+                regressions.append((case_key(result), metric, old, new))
+    return regressions
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Stream synthetic screens over loopback TLS and measure throughput")
+    parser.add_argument('--modes', nargs='+', default=list(SyntheticSource.modes), choices=SyntheticSource.modes)
+    parser.add_argument('--codecs', nargs='+', default=available_codecs())
+    parser.add_argument('--protocols', nargs='+', default=PROTOCOLS, choices=PROTOCOLS)
+    parser.add_argument('--duration', type=float, default=5.0, help="Seconds measured per case")
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--quality', type=int, default=85)
+    parser.add_argument('--workers', type=int, default=None, help="Encode workers, one per CPU by default")
+    parser.add_argument('--adaptive', action='store_true', help="Acknowledge frames so the server adapts its rate")
+    parser.add_argument('--link-kbps', type=float, default=None, help="Emulate a link this slow on the receiving side")
+    parser.add_argument('--tile-cache', type=float, default=0, help="Client tile cache in MiB, 0 for none")
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help="Earlier output to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Relative change counted as a regression")
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--startup', action='store_true', help="Only measure time to first accept for each server mode")
+    args = parser.parse_args()
+    
+    results = []
+    with tempfile.TemporaryDirectory() as certs:
+        make_certs(certs)
+        if args.startup:
+            startup = {}
+            for label in ('headless', 'gui'):
+                port = free_port()
+                startup[label] = measure_startup(certs, startup_commands(certs, port)[label], port)
+                outcome = startup[label]
+                print(f"{label:8} " + (f"first accept after {outcome['accept_ms']:.0f} ms" if 'accept_ms' in outcome
+                                       else f"unavailable: {outcome['error']}"))
+            with open(args.output, 'w') as f:
+                json.dump({'created': time.time(), 'startup': startup}, f, indent=2)
+            sys.exit(0)
+        
+        for mode in args.modes:
+            for codec in args.codecs:
+                for protocol in args.protocols:
+                    result = run_case(certs, mode, codec, protocol, args.duration, args.width, args.height,
+                                      args.fps, args.quality, args.workers, adaptive=args.adaptive,
+                                      link_rate=args.link_kbps and args.link_kbps * 1000 / 8,
+                                      tile_cache=int(args.tile_cache * 1024 * 1024))
+                    results.append(result)
+                    print(f"{mode:9} {codec:5} {protocol:8} {result['fps']:6.1f} fps "
+                          f"{result['bytes_per_frame'] / 1024:8.1f} KiB/frame {result['cpu_ms_per_frame']:7.1f} ms CPU/frame ({result['cpu_percent']:5.1f}%) "
+                          f"latency p50 {result['frame_p50_ms']:.0f} ms input p50 {result['input_p50_ms']:.2f} ms p99 {result['input_p99_ms']:.2f} ms")
+                    if result['rate']:
+                        rate = result['rate']
+                        print(f"  rate control: {rate['fps']} fps, quality {rate['quality']}, scale {rate['scale']:.2f}, "
+                              f"rtt {rate['rtt_ms']:.0f} ms, {rate['kbps']:.0f} kbps ({rate['reason']})")
+                    if result['tile_cache']:
+                        tiles = result['tile_cache']
+                        print(f"  tile cache: {tiles['hit_rate']:.0%} hit rate, {tiles['bytes_saved'] / 1024:.0f} KiB saved, "
+                              f"{tiles['tiles']} tiles in {tiles['bytes'] / 1048576:.1f} MiB, {tiles['evictions']} evicted")
+    
+    with open(args.output, 'w') as f:
+        json.dump({'created': time.time(), 'width': args.width, 'height': args.height,
+                   'fps': args.fps, 'quality': args.quality, 'adaptive': args.adaptive,
+                   'link_kbps': args.link_kbps, 'tile_cache_mib': args.tile_cache, 'results': results}, f, indent=2)
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.threshold)
+        for (mode, codec, protocol), metric, old, new in regressions:
+            print(f"Regression: {mode} {codec} {protocol} {metric} {old:.2f} -> {new:.2f}")
+        if not regressions:
+            print("No regressions against the baseline")
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
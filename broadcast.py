@@ -0,0 +1,262 @@
+import asyncio
+import collections
+import io
+import time
+from PIL import Image, ImageChops
+from capture import CaptureRing, CaptureThread, union_region
+from frames import (dirty_tiles, tiles_to_boxes, boxes_to_tiles, scale_to_viewport, encode_image, hash_tiles,
+                    apply_copies, copy_targets)
+from motion import detect_moves
+
+class EncodedFrame:
+    __slots__ = ('sequence', 'captured_at', 'header', 'payload', 'keyframe', 'hashes', 'image', 'changed')
+    
+    def __init__(self, sequence, captured_at, header, payload, boxes, hashes=None, image=None):
+        self.sequence = sequence
+        self.captured_at = captured_at
+        self.header = header
+        self.payload = payload
+        self.keyframe = header['keyframe']
+        # Viewers that skip this frame get the copied areas as tiles instead
+        self.changed = boxes + copy_targets(header.get('copies', ()))
+        self.hashes = hashes  # Tile digests for viewers with a tile cache, see frames.tile_grid
+        self.image = image  # What was encoded, kept while viewers may still re-encode part of it
+
+class EncoderGroup:
+    # Frames for one (codec, quality, viewport, filter, scale, region) combination, shared by every viewer asking for it
+    def __init__(self, producer, key, history=8):
+        self.producer = producer
+        self.key = key
+        self.codec, self.quality, self.viewport, self.resample, self.limit, self.region = key
+        self.salt = f"{self.codec}:{self.quality}".encode()
+        self.streams = set()
+        self.frames = collections.deque(maxlen=history)
+        self.sequence = 0
+        self.image = None  # Scaled image matching the newest published frame
+        self.captured_at = 0.0
+        self.derived = {}  # Keyframes and catch-up deltas for the current sequence
+        self.derived_sequence = 0
+    
+    def hashing(self):
+        return any(stream.tile_cache is not None for stream in self.streams)
+    
+    def encode_delta(self, raw, area, hashing=False):
+        # area is the part of the desktop the raw frame covers, the union of what every group streams
+        region = self.region or self.producer.source.bounds()
+        if region != area:
+            left, top = region[0] - area[0], region[1] - area[1]
+            if left < 0 or top < 0 or region[2] > area[2] or region[3] > area[3]:
+                return self.image, None  # Grabbed before the capture area grew to take this region in
+            raw = raw.crop((left, top, left + region[2] - region[0], top + region[3] - region[1]))
+        
+        source_width, source_height = raw.size
+        image, scale = scale_to_viewport(raw, self.viewport, self.resample, self.limit)
+        previous = self.image
+        keyframe = previous is None or previous.size != image.size
+        copies = []
+        if keyframe:
+            boxes = [(0, 0, image.width, image.height)]
+        else:
+            diff = ImageChops.difference(previous, image)
+            copies = detect_moves(previous, image, diff.getbbox())
+            if copies:
+                # Diff against what the client will hold once it has made the copies
+                previous = previous.copy()
+                apply_copies(previous, copies)
+                diff = None
+            boxes = tiles_to_boxes(dirty_tiles(previous, image, diff=diff), image.width, image.height)
+            if not boxes and not copies:
+                return image, None
+        
+        header, payload = self.producer.encoder.encode_tiles(image, boxes, keyframe, self.codec, self.quality)
+        if copies:
+            header['copies'] = copies
+        header['scale'] = scale
+        header['source_width'] = source_width
+        header['source_height'] = source_height
+        header['origin_x'], header['origin_y'] = region[:2]
+        hashes = hash_tiles(image, header['tiles'], self.salt) if hashing else None
+        return image, (header, payload, boxes, hashes)
+    
+    def encode_region(self, image, sequence, captured_at, base_header, boxes, keyframe, hashing=False):
+        header, payload = self.producer.encoder.encode_tiles(image, boxes, keyframe, self.codec, self.quality)
+        for field in ('scale', 'source_width', 'source_height', 'origin_x', 'origin_y', 'capture_ms', 'queue_ms'):
+            header[field] = base_header[field]
+        hashes = hash_tiles(image, header['tiles'], self.salt) if hashing else None
+        return EncodedFrame(sequence, captured_at, header, payload, boxes, hashes, image)
+    
+    async def publish(self, raw, area, captured_at, timing):
+        loop = asyncio.get_running_loop()
+        image, encoded = await loop.run_in_executor(self.producer.executor, self.encode_delta, raw, area,
+                                                    self.hashing())
+        self.image = image
+        if encoded is None:
+            return  # Nothing changed, viewers keep their cursor
+        
+        header, payload, boxes, hashes = encoded
+        header.update(timing)
+        self.sequence += 1
+        self.captured_at = captured_at
+        if self.frames:
+            self.frames[-1].image = None  # Only the newest frame is ever sent as it is
+        self.frames.append(EncodedFrame(self.sequence, captured_at, header, payload, boxes, hashes, image))
+        for stream in self.streams:
+            if stream.parked:
+                stream.note_missed(header['keyframe'], self.frames[-1].changed)
+            stream.wakeup.set()
+    
+    def shared(self, key, work, *args):
+        # Concurrent viewers asking for the same derived frame share one encode
+        if self.derived_sequence != self.sequence:
+            self.derived = {}
+            self.derived_sequence = self.sequence
+        task = self.derived.get(key)
+        if task is None:
+            loop = asyncio.get_running_loop()
+            task = asyncio.ensure_future(loop.run_in_executor(self.producer.executor, work, *args))
+            self.derived[key] = task
+        return asyncio.shield(task)
+    
+    async def frame_for(self, cursor, keyframe=False, backlog=None):
+        # backlog holds tiles changed up to the cursor that the viewer never received, after a resume
+        latest = self.frames[-1]
+        if not keyframe and not backlog and cursor == latest.sequence - 1:
+            return latest
+        
+        # Every frame after the cursor must still be in the history for a catch-up delta
+        missed = [frame for frame in self.frames if frame.sequence > (cursor or 0)]
+        if (keyframe or cursor is None or not (missed or backlog) or (missed and missed[0].sequence != cursor + 1) or
+                any(frame.keyframe for frame in missed)):
+            boxes = [(0, 0, self.image.width, self.image.height)]
+            return await self.shared(('keyframe',), self.encode_region, self.image, latest.sequence,
+                                     latest.captured_at, latest.header, boxes, True, self.hashing())
+        
+        # A viewer that fell behind skips ahead with the union of the tiles it missed
+        tiles = set(backlog or ())
+        for frame in missed:
+            tiles |= boxes_to_tiles(frame.changed)
+        boxes = tiles_to_boxes(tiles, self.image.width, self.image.height)
+        if backlog:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.producer.executor, self.encode_region, self.image, latest.sequence,
+                                              latest.captured_at, latest.header, boxes, False, self.hashing())
+        return await self.shared(('catch_up', cursor), self.encode_region, self.image, latest.sequence,
+                                 latest.captured_at, latest.header, boxes, False, self.hashing())
+
+class FrameProducer:
+    # One capture pipeline per server; each encoder group encodes once for all its viewers
+    def __init__(self, source, executor, latency, encoder, ring_size=3):
+        self.source = source
+        self.executor = executor
+        self.encoder = encoder
+        self.latency = latency
+        self.ring = CaptureRing(ring_size)
+        self.capture_thread = CaptureThread(source, self.ring, latency=latency, on_frame=self.on_frame)
+        self.frame_ready = None
+        self.loop = None
+        self.groups = {}
+        self.task = None
+    
+    def on_frame(self, sequence):
+        # Called on the capture thread
+        try:
+            self.loop.call_soon_threadsafe(self.frame_ready.set)
+        except RuntimeError:
+            pass  # A grab that finished after the engine shut down
+    
+    def join(self, stream, key):
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = EncoderGroup(self, key)
+        group.streams.add(stream)
+        if self.task is None:
+            self.loop = asyncio.get_running_loop()
+            self.frame_ready = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+        return group
+    
+    def leave(self, stream, group):
+        group.streams.discard(stream)
+        if not group.streams:
+            self.groups.pop(group.key, None)
+        if not self.groups:
+            self.capture_thread.stop()
+            if self.task is not None:
+                self.task.cancel()
+                self.task = None
+    
+    def capture_region(self):
+        # Grab only as much of the desktop as the viewers are looking at
+        bounds = self.source.bounds()
+        regions = {group.region or bounds for group in self.groups.values()}
+        return None if regions <= {bounds} else union_region(regions)
+    
+    def interval(self):
+        # Capture as fast as the most demanding viewer wants, slower viewers skip ahead
+        return min((stream.interval for group in self.groups.values() for stream in group.streams), default=0.05)
+    
+    async def run(self):
+        processed = 0
+        try:
+            self.capture_thread.start()
+            while True:
+                self.capture_thread.interval = self.interval()
+                self.capture_thread.region = self.capture_region()
+                await self.frame_ready.wait()
+                self.frame_ready.clear()
+                
+                # Encoders always take the newest raw frame, grabs they were too slow for are skipped
+                sequence, captured_at, duration, raw, area = self.ring.latest()
+                if sequence == processed:
+                    continue
+                processed = sequence
+                
+                started = time.perf_counter()
+                self.latency.record('capture_queue', started - captured_at)
+                # Per-frame server timings travel in the frame header
+                timing = {'capture_ms': duration * 1000, 'queue_ms': (started - captured_at) * 1000}
+                groups = list(self.groups.values())
+                await asyncio.gather(*(group.publish(raw, area, captured_at, timing) for group in groups))
+                self.latency.record('encode', time.perf_counter() - started)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error producing frames: {e}")
+        finally:
+            self.capture_thread.stop()
+
+class Thumbnailer:
+    # A small picture of the whole desktop for navigating between regions, shared by every viewer
+    def __init__(self, source, executor, codec='jpeg', width=200, quality=60):
+        self.source = source
+        self.executor = executor
+        self.codec = codec
+        self.width = width
+        self.quality = quality
+        self.task = None
+        self.taken_at = 0.0
+    
+    def render(self):
+        desktop = self.source.desktop()
+        image = self.source.grab_region(desktop)
+        image.thumbnail((self.width, self.width), Image.Resampling.BOX)
+        output = io.BytesIO()
+        encode_image(image, output, self.codec, self.quality)
+        header = {
+            'type': 'thumbnail',
+            'width': image.width,
+            'height': image.height,
+            'codec': self.codec,
+            'bytes': output.tell(),
+            'desktop': desktop,
+            'monitors': self.source.monitors()
+        }
+        return header, output.getvalue()
+    
+    async def get(self, max_age=1.0):
+        # Viewers asking within max_age of the last grab share it
+        if self.task is None or (self.task.done() and time.perf_counter() - self.taken_at >= max_age):
+            loop = asyncio.get_running_loop()
+            self.taken_at = time.perf_counter()
+            self.task = asyncio.ensure_future(loop.run_in_executor(self.executor, self.render))
+        return await asyncio.shield(self.task)
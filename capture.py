@@ -0,0 +1,277 @@
+import importlib.util
+import random
+import threading
+import time
+from PIL import Image, ImageDraw
+
+# Regions are (left, top, right, bottom) in desktop coordinates, the space mouse input is injected in
+
+def union_region(regions):
+    lefts, tops, rights, bottoms = zip(*regions)
+    return (min(lefts), min(tops), max(rights), max(bottoms))
+
+def clamp_region(region, desktop, minimum=16):
+    # Fits a requested region inside the desktop, moving it rather than shrinking it where possible
+    left, top, right, bottom = (int(value) for value in region)
+    width = max(minimum, min(right - left, desktop[2] - desktop[0]))
+    height = max(minimum, min(bottom - top, desktop[3] - desktop[1]))
+    left = max(desktop[0], min(left, desktop[2] - width))
+    top = max(desktop[1], min(top, desktop[3] - height))
+    return (left, top, left + width, top + height)
+
+def monitor_region(monitor):
+    return (monitor['left'], monitor['top'], monitor['left'] + monitor['width'], monitor['top'] + monitor['height'])
+
+class CaptureSource:
+    name = 'base'
+    
+    def grab(self):
+        raise NotImplementedError
+    
+    def bounds(self):
+        # The region grab() covers
+        raise NotImplementedError
+    
+    def monitors(self):
+        return [self.bounds()]
+    
+    def desktop(self):
+        return union_region(self.monitors())
+    
+    def grab_region(self, region):
+        left, top = self.bounds()[:2]
+        return self.grab().crop((region[0] - left, region[1] - top, region[2] - left, region[3] - top))
+    
+    def close(self):
+        pass
+
+class ImageGrabSource(CaptureSource):
+    # grab() covers the primary monitor; on Windows the others are listed through pywin32 when it is installed
+    name = 'imagegrab'
+    
+    def __init__(self):
+        self.size = None
+    
+    def grab(self):
+        from PIL import ImageGrab
+        frame = ImageGrab.grab()
+        self.size = frame.size
+        return frame
+    
+    def bounds(self):
+        if self.size is None:
+            self.grab()
+        return (0, 0, *self.size)
+    
+    def monitors(self):
+        try:
+            import win32api
+            import win32con
+        except ImportError:
+            return [self.bounds()]
+        # Primary first, it is the one grab() returns
+        monitors = [win32api.GetMonitorInfo(handle) for handle, _, _ in win32api.EnumDisplayMonitors()]
+        monitors.sort(key=lambda info: not info['Flags'] & win32con.MONITORINFOF_PRIMARY)
+        return [tuple(info['Monitor']) for info in monitors]
+    
+    def grab_region(self, region):
+        from PIL import ImageGrab
+        # With all_screens the bbox is in virtual desktop coordinates, so regions on any monitor work
+        return ImageGrab.grab(bbox=region, all_screens=True)
+
+class MssSource(CaptureSource):
+    name = 'mss'
+    
+    def __init__(self, monitor=1):
+        import mss  # Only loaded when this backend is picked
+        self.mss = mss
+        self.monitor = monitor
+        self.local = threading.local()  # mss handles must stay on the thread that created them
+    
+    def screen(self):
+        screen = getattr(self.local, 'screen', None)
+        if screen is None:
+            screen = self.local.screen = self.mss.mss()
+        return screen
+    
+    def grab(self):
+        shot = self.screen().grab(self.screen().monitors[self.monitor])
+        return Image.frombuffer('RGB', shot.size, shot.bgra, 'raw', 'BGRX')
+    
+    def bounds(self):
+        return monitor_region(self.screen().monitors[self.monitor])
+    
+    def monitors(self):
+        # mss lists the whole virtual desktop first, then each monitor
+        return [monitor_region(monitor) for monitor in self.screen().monitors[1:]]
+    
+    def desktop(self):
+        return monitor_region(self.screen().monitors[0])
+    
+    def grab_region(self, region):
+        left, top, right, bottom = region
+        shot = self.screen().grab({'left': left, 'top': top, 'width': right - left, 'height': bottom - top})
+        return Image.frombuffer('RGB', shot.size, shot.bgra, 'raw', 'BGRX')
+
+class SyntheticSource(CaptureSource):
+    # Deterministic frames for headless testing and benchmarking
+    name = 'synthetic'
+    modes = ('static', 'typing', 'scrolling', 'video', 'switching')
+    
+    def __init__(self, width=1920, height=1080, mode='static', seed=0, scroll_step=16, monitors=1, switch_frames=10):
+        if mode not in self.modes:
+            raise ValueError(f"Unknown synthetic mode {mode}")
+        self.width = width
+        self.height = height
+        # The desktop is split into side by side monitors, the first one is what grab() returns
+        self.columns = [width * index // monitors for index in range(monitors + 1)]
+        self.mode = mode
+        self.seed = seed
+        self.scroll_step = scroll_step
+        self.switch_frames = switch_frames
+        self.index = 0
+        self.lock = threading.Lock()
+        self.page = self.render_page(height * 4)
+        self.base = self.page.crop((0, 0, width, height))
+    
+    def render_page(self, height):
+        page = Image.new('RGB', (self.width, height), (30, 30, 30))
+        draw = ImageDraw.Draw(page)
+        for line, y in enumerate(range(4, height - 16, 18)):
+            draw.text((8, y), f"{line:05d}  synthetic log line for benchmarking {line * 7919 % 100003:06d}", fill=(200, 200, 200))
+        return page
+    
+    def bounds(self):
+        return (0, 0, self.columns[1], self.height)
+    
+    def monitors(self):
+        return [(left, 0, right, self.height) for left, right in zip(self.columns, self.columns[1:])]
+    
+    def grab(self):
+        return self.grab_region(self.bounds())
+    
+    def grab_region(self, region):
+        frame = self.render()
+        return frame if region == (0, 0, self.width, self.height) else frame.crop(region)
+    
+    def render(self):
+        with self.lock:
+            index = self.index
+            self.index += 1
+        
+        if self.mode == 'static':
+            return self.base.copy()
+        
+        if self.mode == 'typing':
+            frame = self.base.copy()
+            draw = ImageDraw.Draw(frame)
+            draw.rectangle((0, self.height - 40, self.width, self.height), fill=(0, 0, 0))
+            text = "$ tail -f /var/log/benchmark.log | grep --line-buffered typing " * 3
+            draw.text((8, self.height - 30), text[:index % len(text) + 1], fill=(0, 255, 0))
+            return frame
+        
+        if self.mode == 'scrolling':
+            offset = (index * self.scroll_step) % (self.page.height - self.height)
+            return self.page.crop((0, offset, self.width, offset + self.height))
+        
+        if self.mode == 'switching':
+            # Flips between three windows, showing content the viewer has seen before
+            window = index // self.switch_frames % 3
+            return self.page.crop((0, window * self.height, self.width, (window + 1) * self.height))
+        
+        # Video: a noisy region in the middle changes completely every frame
+        frame = self.base.copy()
+        region = (self.width // 2, self.height // 2)
+        noise = random.Random(self.seed + index).randbytes(region[0] * region[1] * 3)
+        frame.paste(Image.frombytes('RGB', region, noise), (self.width // 4, self.height // 4))
+        return frame
+
+CAPTURE_SOURCES = {
+    'imagegrab': ImageGrabSource,
+    'mss': MssSource,
+    'synthetic': SyntheticSource
+}
+
+def available_sources():
+    sources = ['imagegrab', 'synthetic']
+    if importlib.util.find_spec('mss') is not None:
+        sources.insert(0, 'mss')
+    return sources
+
+def create_source(name='auto', **options):
+    if name == 'auto':
+        name = available_sources()[0]
+    if name == 'mss' and 'mss' not in available_sources():
+        raise ValueError("The mss capture backend is not installed")
+    return CAPTURE_SOURCES[name](**options)
+
+class CaptureRing:
+    # The newest few raw frames with their capture timestamps
+    def __init__(self, size=3):
+        self.size = size
+        self.frames = [None] * size
+        self.sequence = 0
+        self.lock = threading.Lock()
+    
+    def push(self, frame, captured_at, duration=0.0, region=None):
+        # region is the part of the desktop the frame covers
+        with self.lock:
+            self.sequence += 1
+            self.frames[self.sequence % self.size] = (self.sequence, captured_at, duration, frame, region)
+            return self.sequence
+    
+    def latest(self):
+        with self.lock:
+            if not self.sequence:
+                return None
+            return self.frames[self.sequence % self.size]
+
+class CaptureThread:
+    def __init__(self, source, ring, interval=0.05, latency=None, on_frame=None):
+        self.source = source
+        self.ring = ring
+        self.interval = interval
+        self.latency = latency
+        self.on_frame = on_frame or (lambda sequence: None)
+        self.region = None  # Part of the desktop to grab, None for the source's default
+        self.stopped = None
+    
+    def start(self):
+        if self.stopped is not None:
+            return
+        # Each run gets its own stop flag so a quick restart never leaves two threads grabbing
+        self.stopped = threading.Event()
+        threading.Thread(target=self.run, args=(self.stopped,), daemon=True).start()
+    
+    def stop(self):
+        if self.stopped is not None:
+            self.stopped.set()
+            self.stopped = None
+    
+    def run(self, stopped):
+        next_tick = time.monotonic()
+        while not stopped.is_set():
+            started = time.perf_counter()
+            region = self.region
+            try:
+                if region is None:
+                    frame = self.source.grab()
+                    region = self.source.bounds()
+                else:
+                    frame = self.source.grab_region(region)
+            except Exception as e:
+                print(f"Error capturing frame: {e}")
+                stopped.wait(self.interval)
+                continue
+            
+            captured_at = time.perf_counter()
+            if self.latency is not None:
+                self.latency.record('capture', captured_at - started)
+            self.on_frame(self.ring.push(frame, captured_at, captured_at - started, region))
+            
+            next_tick += self.interval
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                stopped.wait(delay)
+            else:
+                next_tick = time.monotonic()
@@ -1,14 +1,169 @@
 import socket
 import ssl
-import json
 import threading
+import queue
+import itertools
+import collections
+import json
+import time
+import uuid
 import tkinter as tk
+from tkinter import filedialog, simpledialog, ttk
 from PIL import Image, ImageTk
-import io
 from datetime import datetime
+from protocol import Channel, PROTOCOLS, PROTOCOL_JSON
+from frames import TileCache, apply_tiles, decode_image
+from transfer import TransferClient, TRANSFER_MESSAGES
+from metrics import StageLatency
+
+# Lower values are sent first
+PRIORITY_INPUT = 0
+PRIORITY_CONTROL = 1
+PRIORITY_STREAM = 2
+PRIORITY_BULK = 3  # File chunks, only sent when nothing else is queued
+
+def stage_value(stages, stage, field):
+    return f"{stages[stage][field]:.1f}" if stage in stages else "-"
+
+class SendQueue:
+    def __init__(self):
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.latest = {}  # Newest sequence number queued per key
+        self.dropped = 0
+    
+    def put(self, message, priority=PRIORITY_CONTROL, key=None, payload=None):
+        # A keyed message supersedes any older one with the same key still in the queue
+        with self.lock:
+            sequence = next(self.sequence)
+            if key:
+                self.latest[key] = sequence
+        self.queue.put((priority, sequence, key, message, payload))
+    
+    def get(self, timeout=None):
+        while True:
+            priority, sequence, key, message, payload = self.queue.get(timeout=timeout)
+            with self.lock:
+                if key and self.latest.get(key) != sequence:
+                    self.dropped += 1
+                    continue
+            return message, payload
+    
+    def depth(self):
+        return self.queue.qsize()
+
+class FrameMailbox:
+    # Holds only the newest rendered frame, anything the UI did not get to in time is dropped
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frame = None
+        self.dropped = 0
+    
+    def put(self, frame):
+        with self.lock:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+    
+    def take(self):
+        with self.lock:
+            frame, self.frame = self.frame, None
+            return frame
+
+class RemoteBrowser:
+    # Remote directory window; each page of a listing is shown as soon as it arrives
+    def __init__(self, client):
+        self.client = client
+        self.window = None
+        self.request_id = 0
+        self.path = ''
+        self.sep = '\\'
+        self.count = 0
+    
+    def open(self):
+        if self.window is not None:
+            self.window.lift()
+            return
+        
+        self.window = tk.Toplevel(self.client.root)
+        self.window.title("Remote Files")
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        
+        bar = tk.Frame(self.window)
+        bar.pack(fill=tk.X, padx=5, pady=5)
+        tk.Button(bar, text="Up", command=self.up).pack(side=tk.LEFT)
+        self.path_entry = tk.Entry(bar)
+        self.path_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        self.path_entry.bind("<Return>", lambda event: self.browse(self.path_entry.get()))
+        tk.Button(bar, text="Go", command=lambda: self.browse(self.path_entry.get())).pack(side=tk.LEFT)
+        
+        self.tree = ttk.Treeview(self.window, columns=('size', 'modified', 'type'))
+        self.tree.heading('#0', text="Name")
+        self.tree.heading('size', text="Size")
+        self.tree.heading('modified', text="Modified")
+        self.tree.heading('type', text="Type")
+        scrollbar = tk.Scrollbar(self.window, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.pack(fill=tk.BOTH, expand=True, padx=5)
+        self.tree.bind("<Double-1>", self.on_open)
+        
+        self.status = tk.Label(self.window, text="", anchor=tk.W)
+        self.status.pack(fill=tk.X, padx=5, pady=2)
+        self.browse(self.path)
+    
+    def close(self):
+        self.window.destroy()
+        self.window = None
+    
+    def browse(self, path):
+        # Pages of an older request that are still in flight are ignored
+        self.request_id += 1
+        self.count = 0
+        self.tree.delete(*self.tree.get_children())
+        self.status.config(text="Loading...")
+        self.client.send_message({'type': 'browse', 'id': self.request_id, 'path': path})
+    
+    def join(self, name):
+        return self.path.rstrip(self.sep) + self.sep + name
+    
+    def up(self):
+        self.browse(self.path.rstrip(self.sep).rsplit(self.sep, 1)[0] + self.sep)
+    
+    def add_page(self, message):
+        if self.window is None or message['id'] != self.request_id:
+            return
+        if 'error' in message:
+            self.status.config(text=f"Error: {message['error']}")
+            return
+        
+        if not self.count:
+            self.path = message['path']
+            self.sep = message['sep']
+            self.path_entry.delete(0, tk.END)
+            self.path_entry.insert(0, self.path)
+        for name, size, mtime, kind in message['entries']:
+            modified = datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M')
+            self.tree.insert('', tk.END, text=name, values=(size if kind == 'file' else '', modified, kind))
+        self.count += len(message['entries'])
+        self.status.config(text=f"{self.count} entries" + ("" if message['done'] else ", loading..."))
+    
+    def on_open(self, event):
+        item = self.tree.focus()
+        if not item:
+            return
+        name = self.tree.item(item, 'text')
+        kind = self.tree.item(item, 'values')[2]
+        if kind in ('dir', 'link'):
+            self.browse(self.join(name))
+            return
+        local_path = filedialog.asksaveasfilename(title="Save as", initialfile=name, parent=self.window)
+        if local_path:
+            self.client.transfers.download(self.join(name), local_path)
 
 class SecureClient:
-    def __init__(self, host='localhost', port=4443):
+    def __init__(self, host='localhost', port=4443, input_flush_interval=4):
         self.host = host
         self.port = port
         
@@ -19,22 +174,100 @@ class SecureClient:
         self.remote_width = 1920  # Default, will be updated
         self.remote_height = 1080  # Default, will be updated
         
+        # Where the remote image sits on the canvas, in canvas pixels per remote pixel
+        self.display_scale = 1.0
+        self.display_offset = (0, 0)
+        self.remote_origin = (0, 0)  # Desktop position of the streamed region's top left corner
+        self.viewport_after_id = None
+        self.canvas_size = (1, 1)  # Tracked on the UI thread so the decode worker never calls into Tk
+        
         # Initialize screenshot_interval before setup_gui
         self.screenshot_interval = 50  # ms
+        self.latency_budget = 150  # ms, the server's rate control keeps frames within it
+        
+        # Streamed part of the remote desktop; regions are (left, top, right, bottom) in desktop pixels
+        self.view_region = None  # None for the server's default, its primary monitor
+        self.monitors = []
+        self.desktop = None
+        self.selecting = False  # Next drag on the canvas picks a region instead of sending input
+        self.selection_start = None
+        self.thumbnail_interval = 1.0  # s
+        self.thumbnail_photo = None
+        self.thumbnail_scale = 1.0  # Thumbnail pixels per desktop pixel
+        self.browser = RemoteBrowser(self)
         
         # GUI setup
         self.setup_gui()
         
         self.conn = None
+        self.channel = None
         self.running = False
+        self.stopped = None  # Stop flag of the current connection's workers
         self.screenshot_thread = None
         
+        # A dropped connection is retried with backoff and resumes the stream where it left off
+        self.session_token = None  # Identifies our stream to the server across reconnects
+        self.tls_session = None  # Lets a reconnect skip the full mutual-TLS handshake
+        self.connect_timeout = 5.0
+        self.reconnect_min = 0.5  # s
+        self.reconnect_max = 10.0  # s
+        self.reconnect_delay = self.reconnect_min
+        self.reconnect_after_id = None
+        
+        # Receive -> decode/scale worker -> one-slot mailbox -> UI thread, which only blits
+        self.decode_thread = None
+        self.mailbox = FrameMailbox()
+        self.ui_calls = queue.Queue()  # Work other threads need done on the Tk thread
+        self.ui_poll_interval = 5  # ms
+        self.photo = None
+        self.canvas_image = None
+        
+        # All outbound traffic goes through one writer thread
+        self.send_queue = SendQueue()
+        self.writer_thread = None
+        
+        # File transfers do their disk I/O on their own thread
+        self.transfers = TransferClient(self.send_transfer, self.release_payload,
+                                        lambda transfer, text: self.run_in_ui(self.update_status, text))
+        
+        # Persistent framebuffer patched with tile deltas
+        self.framebuffer = None
+        self.frame_sequence = None  # Server sequence of the last frame decoded into it
+        self.keyframe_requested = True
+        
+        # Decoded tiles by content hash, so content shown recently comes back as a short reference
+        # Only the decode worker touches it; the epoch tells the server when it was emptied
+        self.tile_cache = TileCache(64 * 1024 * 1024)
+        self.cache_epoch = 0
+        self.server_codecs = ['png']
+        
         # Mouse and keyboard tracking
         self.last_mouse_pos = (0, 0)
         self.pressed_keys = set()
         
         # Performance settings
         self.mouse_threshold = 5  # pixels
+        
+        # Input is coalesced and shipped as one batch per flush tick
+        self.input_flush_interval = input_flush_interval  # ms
+        self.pending_input = []
+        self.flush_after_id = None
+        self.events_received = 0
+        self.events_sent = 0
+        self.pending_since = None
+        
+        # Per-stage timings, summarised and reset once a second for the overlay and the export
+        self.latency = StageLatency()
+        self.stats_time = time.perf_counter()
+        self.clock_samples = collections.deque(maxlen=8)  # (round trip, server clock minus ours)
+        self.clock_offset = None
+        self.rtt = None
+        self.server_stats = {}
+        self.overlay_text = ""
+        self.stats_file = None
+        
+        self.root.after(self.ui_poll_interval, self.poll_ui)
+        self.root.after(1000, self.stats_tick)
     
     def setup_ssl(self):
         self.context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
@@ -73,6 +306,9 @@ class SecureClient:
         self.status_label = tk.Label(status_frame, text="Disconnected")
         self.status_label.pack(padx=5, pady=5)
         
+        self.input_stats_label = tk.Label(status_frame, text="Input: 0 events, 0 sent")
+        self.input_stats_label.pack(padx=5, pady=5)
+        
         # Performance Frame
         perf_frame = tk.LabelFrame(left_panel, text="Performance")
         perf_frame.pack(fill=tk.X, padx=5, pady=5)
@@ -82,14 +318,58 @@ class SecureClient:
         self.refresh_scale.set(self.screenshot_interval)
         self.refresh_scale.pack(padx=5, pady=2, fill=tk.X)
         
+        # With adaptive rate on, the refresh rate and quality settings are ceilings
+        self.adaptive_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(perf_frame, text="Adaptive Rate", variable=self.adaptive_var, command=self.update_adaptive).pack(padx=5, pady=2)
+        
+        tk.Button(perf_frame, text="Full Refresh", command=self.request_keyframe).pack(padx=5, pady=2, fill=tk.X)
+        
+        self.overlay_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(perf_frame, text="Stats Overlay", variable=self.overlay_var, command=self.draw_overlay).pack(padx=5, pady=2)
+        self.record_button = tk.Button(perf_frame, text="Record Stats...", command=self.toggle_recording)
+        self.record_button.pack(padx=5, pady=2, fill=tk.X)
+        
         # Quality Frame
         quality_frame = tk.LabelFrame(left_panel, text="Image Quality")
         quality_frame.pack(fill=tk.X, padx=5, pady=5)
         
         self.quality_var = tk.IntVar(value=85)
-        self.quality_scale = tk.Scale(quality_frame, from_=1, to=100, orient=tk.HORIZONTAL, variable=self.quality_var)
+        self.quality_scale = tk.Scale(quality_frame, from_=1, to=100, orient=tk.HORIZONTAL, variable=self.quality_var, command=self.update_quality)
         self.quality_scale.pack(padx=5, pady=2, fill=tk.X)
         
+        tk.Label(quality_frame, text="Codec:").pack(padx=5, pady=2)
+        self.codec_var = tk.StringVar(value='jpeg')
+        self.codec_menu = tk.OptionMenu(quality_frame, self.codec_var, 'png', 'jpeg', 'webp', 'webp_lossless', command=self.select_codec)
+        self.codec_menu.pack(padx=5, pady=2, fill=tk.X)
+        
+        tk.Label(quality_frame, text="Scaling Filter:").pack(padx=5, pady=2)
+        self.filter_var = tk.StringVar(value='auto')
+        tk.OptionMenu(quality_frame, self.filter_var, 'auto', 'nearest', 'box', 'bilinear', 'bicubic', 'lanczos', command=self.select_filter).pack(padx=5, pady=2, fill=tk.X)
+        
+        # View Frame
+        view_controls = tk.LabelFrame(left_panel, text="View")
+        view_controls.pack(fill=tk.X, padx=5, pady=5)
+        
+        self.monitor_var = tk.StringVar(value='Default')
+        self.monitor_menu = tk.OptionMenu(view_controls, self.monitor_var, 'Default', command=self.select_monitor)
+        self.monitor_menu.pack(padx=5, pady=2, fill=tk.X)
+        
+        self.region_button = tk.Button(view_controls, text="Select Region", command=self.toggle_selecting)
+        self.region_button.pack(padx=5, pady=2, fill=tk.X)
+        
+        # Whole remote desktop, the rectangle marks what is streamed; click to move there
+        self.thumbnail_canvas = tk.Canvas(view_controls, width=200, height=112, bg='black', highlightthickness=0)
+        self.thumbnail_canvas.pack(padx=5, pady=2)
+        self.thumbnail_canvas.bind("<Button-1>", self.on_thumbnail_click)
+        
+        # Files Frame
+        files_frame = tk.LabelFrame(left_panel, text="Files")
+        files_frame.pack(fill=tk.X, padx=5, pady=5)
+        
+        tk.Button(files_frame, text="Upload File", command=self.upload_file).pack(padx=5, pady=2, fill=tk.X)
+        tk.Button(files_frame, text="Download File", command=self.download_file).pack(padx=5, pady=2, fill=tk.X)
+        tk.Button(files_frame, text="Browse Files", command=self.browser.open).pack(padx=5, pady=2, fill=tk.X)
+        
         # Remote View Frame
         view_frame = tk.LabelFrame(main_container, text="Remote View")
         view_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
@@ -103,6 +383,7 @@ class SecureClient:
         self.canvas.bind("<ButtonRelease>", self.on_mouse_release)
         self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)
         self.canvas.bind("<Leave>", self.confine_mouse)
+        self.canvas.bind("<Configure>", self.on_canvas_resize)
         
         self.root.bind("<Key>", self.on_key_press)
         self.root.bind("<KeyRelease>", self.on_key_release)
@@ -113,22 +394,250 @@ class SecureClient:
     
     def update_refresh_rate(self, value):
         self.screenshot_interval = int(value)
+        if self.running:
+            self.subscribe()
+    
+    def update_adaptive(self):
+        if self.running:
+            self.subscribe()
+    
+    def update_quality(self, value):
+        if self.running:
+            self.subscribe()
+    
+    def select_codec(self, codec):
+        self.codec_var.set(codec)
+        if self.running:
+            self.subscribe()
+    
+    def select_filter(self, value):
+        if self.running:
+            self.subscribe()
+    
+    def on_canvas_resize(self, event):
+        self.canvas_size = (event.width, event.height)
+        # Debounce so an interactive window resize sends one viewport update
+        if self.viewport_after_id:
+            self.root.after_cancel(self.viewport_after_id)
+        self.viewport_after_id = self.root.after(100, self.send_viewport)
+    
+    def send_viewport(self):
+        self.viewport_after_id = None
+        if self.running:
+            self.send_message({
+                'type': 'viewport',
+                'width': self.canvas_size[0],
+                'height': self.canvas_size[1]
+            }, PRIORITY_STREAM, key='viewport')
+    
+    def to_remote(self, x, y):
+        # Canvas position to desktop coordinates, through the scaling and the streamed region's offset
+        remote_x = (x - self.display_offset[0]) / self.display_scale
+        remote_y = (y - self.display_offset[1]) / self.display_scale
+        return (self.remote_origin[0] + max(0, min(int(remote_x), self.remote_width - 1)),
+                self.remote_origin[1] + max(0, min(int(remote_y), self.remote_height - 1)))
+    
+    def set_monitors(self, monitors, desktop):
+        self.monitors = [tuple(monitor) for monitor in monitors]
+        self.desktop = tuple(desktop)
+        
+        choices = ['Default', 'All Monitors'] + [f"Monitor {index}" for index in range(1, len(self.monitors) + 1)]
+        if self.monitor_var.get() not in choices + ['Region']:
+            self.monitor_var.set('Default')
+        menu = self.monitor_menu['menu']
+        menu.delete(0, tk.END)
+        for choice in choices:
+            menu.add_command(label=choice, command=lambda choice=choice: self.select_monitor(choice))
+    
+    def select_monitor(self, choice):
+        self.monitor_var.set(choice)
+        if choice == 'Default':
+            self.set_view_region(None)
+        elif choice == 'All Monitors':
+            self.set_view_region(self.desktop)
+        else:
+            self.set_view_region(self.monitors[int(choice.split()[-1]) - 1])
+    
+    def set_view_region(self, region):
+        self.view_region = tuple(region) if region else None
+        if self.running:
+            self.subscribe()
+    
+    def toggle_selecting(self):
+        self.selecting = not self.selecting
+        self.selection_start = None
+        self.canvas.delete('selection')
+        self.region_button.config(relief=tk.SUNKEN if self.selecting else tk.RAISED)
+    
+    def drag_selection(self, event):
+        if self.selection_start is not None:
+            self.canvas.delete('selection')
+            self.canvas.create_rectangle(*self.selection_start, event.x, event.y, outline='yellow', dash=(4, 2), tags='selection')
+    
+    def finish_selection(self, event):
+        start, self.selection_start = self.selection_start, None
+        self.toggle_selecting()
+        if start is None:
+            return
+        
+        (left, top), (right, bottom) = self.to_remote(*start), self.to_remote(event.x, event.y)
+        if abs(right - left) < 16 or abs(bottom - top) < 16:
+            return  # A click, not a drag
+        self.monitor_var.set('Region')
+        self.set_view_region((min(left, right), min(top, bottom), max(left, right) + 1, max(top, bottom) + 1))
+    
+    def show_thumbnail(self, image, message):
+        self.set_monitors(message['monitors'], message['desktop'])
+        self.thumbnail_scale = image.width / (self.desktop[2] - self.desktop[0])
+        self.thumbnail_photo = ImageTk.PhotoImage(image)
+        self.thumbnail_canvas.config(width=image.width, height=image.height)
+        self.thumbnail_canvas.delete("all")
+        self.thumbnail_canvas.create_image(0, 0, image=self.thumbnail_photo, anchor=tk.NW)
+        
+        left, top = self.remote_origin
+        right, bottom = left + self.remote_width, top + self.remote_height
+        self.thumbnail_canvas.create_rectangle(*self.to_thumbnail(left, top), *self.to_thumbnail(right, bottom), outline='yellow')
+    
+    def to_thumbnail(self, x, y):
+        return ((x - self.desktop[0]) * self.thumbnail_scale, (y - self.desktop[1]) * self.thumbnail_scale)
+    
+    def on_thumbnail_click(self, event):
+        if self.desktop is None:
+            return
+        x = self.desktop[0] + event.x / self.thumbnail_scale
+        y = self.desktop[1] + event.y / self.thumbnail_scale
+        
+        if self.view_region is None or self.monitor_var.get() != 'Region':
+            # Jump to the monitor under the click
+            for index, (left, top, right, bottom) in enumerate(self.monitors, 1):
+                if left <= x < right and top <= y < bottom:
+                    self.select_monitor(f"Monitor {index}")
+            return
+        
+        # Keep the region's size and centre it on the click; the server keeps it on the desktop
+        left, top, right, bottom = self.view_region
+        left, top = int(x - (right - left) / 2), int(y - (bottom - top) / 2)
+        self.set_view_region((left, top, left + right - self.view_region[0], top + bottom - self.view_region[1]))
+    
+    def set_server_codecs(self, codecs):
+        self.server_codecs = codecs
+        if self.codec_var.get() not in codecs:
+            self.codec_var.set(codecs[0])
+        
+        menu = self.codec_menu['menu']
+        menu.delete(0, tk.END)
+        for codec in codecs:
+            menu.add_command(label=codec, command=lambda codec=codec: self.select_codec(codec))
+    
+    def subscribe(self, resume=False):
+        # Retargets the server's push rate and encoding; the server keeps its own capture clock
+        # A pending keyframe request rides along until a keyframe actually arrives
+        message = {
+            'type': 'subscribe',
+            'session': self.session_token,
+            'fps': 1000 / self.screenshot_interval,
+            'codec': self.codec_var.get(),
+            'quality': self.quality_var.get(),
+            'filter': self.filter_var.get(),
+            'keyframe': self.keyframe_requested,
+            'adaptive': self.adaptive_var.get(),
+            'budget_ms': self.latency_budget,
+            'region': self.view_region,
+            'thumbnail': self.thumbnail_interval,
+            'tile_cache': {'max_bytes': self.tile_cache.max_bytes, 'epoch': self.cache_epoch}
+        }
+        if resume and self.framebuffer is not None and self.frame_sequence is not None:
+            # After a reconnect, ask only for what changed since the frame we already hold
+            message['resume'] = self.frame_sequence
+        self.send_message(message, PRIORITY_STREAM, key='subscribe')
+    
+    def request_keyframe(self):
+        self.keyframe_requested = True
+        if self.running:
+            self.send_message({'type': 'keyframe'}, PRIORITY_STREAM, key='keyframe')
     
     def update_status(self, message):
         self.statusbar.config(text=f"{datetime.now().strftime('%H:%M:%S')}: {message}")
     
-    def send_message(self, message):
+    def send_message(self, message, priority=PRIORITY_CONTROL, key=None):
         if not self.conn:
             return
         
+        self.send_queue.put(message, priority, key)
+    
+    def send_transfer(self, message, payload=None, bulk=False):
+        # Transfers left without a connection resume from their verified offset after the next one
+        if self.conn:
+            self.send_queue.put(message, PRIORITY_BULK if bulk else PRIORITY_CONTROL, payload=payload)
+    
+    def release_payload(self, payload):
+        if self.channel:
+            self.channel.release(payload)
+    
+    def upload_file(self):
+        local_path = filedialog.askopenfilename(title="File to upload")
+        if not local_path:
+            return
+        remote_path = simpledialog.askstring("Upload", "Remote path:", parent=self.root)
+        if remote_path:
+            self.transfers.upload(local_path, remote_path)
+    
+    def download_file(self):
+        remote_path = simpledialog.askstring("Download", "Remote path:", parent=self.root)
+        if not remote_path:
+            return
+        local_path = filedialog.asksaveasfilename(title="Save as")
+        if local_path:
+            self.transfers.download(remote_path, local_path)
+    
+    def writer_loop(self, channel, send_queue, negotiated, stopped):
+        # Nothing goes out before the hello exchange, or the reply could come back in the framing being left
+        while not negotiated.wait(0.5):
+            if stopped.is_set():
+                return
         try:
-            data = json.dumps(message).encode()
-            size = len(data)
-            self.conn.send(size.to_bytes(8, byteorder='big'))
-            self.conn.sendall(data)
+            while not stopped.is_set():
+                try:
+                    message, payload = send_queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                
+                channel.send(message, payload)
         except Exception as e:
-            self.update_status(f"Error sending message: {e}")
-            self.disconnect()
+            if not stopped.is_set():
+                self.run_in_ui(self.connection_lost, f"Error sending message: {e}", channel)
+    
+    def queue_input(self, message):
+        self.events_received += 1
+        
+        # A move right after another move replaces it; clicks and keys are never reordered
+        last = self.pending_input[-1] if self.pending_input else None
+        if (message['data'].get('type') == 'move' and last and
+                last['type'] == 'mouse' and last['data']['type'] == 'move'):
+            self.pending_input[-1] = message
+        else:
+            self.pending_input.append(message)
+        
+        if self.pending_since is None:
+            self.pending_since = time.perf_counter()
+        if self.flush_after_id is None:
+            self.flush_after_id = self.root.after(self.input_flush_interval, self.flush_input)
+    
+    def flush_input(self):
+        self.flush_after_id = None
+        if not self.pending_input:
+            return
+        
+        events, self.pending_input = self.pending_input, []
+        self.events_sent += len(events)
+        message = {'type': 'batch', 'events': events}
+        if self.clock_offset is not None:
+            # Stamped in the server's clock so it can time the events up to their injection
+            message['sent'] = time.time() + self.clock_offset
+        self.send_message(message, PRIORITY_INPUT)
+        self.latency.record('input_flush', time.perf_counter() - self.pending_since)
+        self.pending_since = None
+        self.input_stats_label.config(text=f"Input: {self.events_received} events, {self.events_sent} sent, queue {self.send_queue.depth()}")
     
     def confine_mouse(self, event):
         x = self.root.winfo_pointerx() - self.canvas.winfo_rootx()
@@ -142,20 +651,19 @@ class SecureClient:
     def on_mouse_motion(self, event):
         if not self.conn:
             return
+        if self.selecting:
+            self.drag_selection(event)
+            return
         
-        x = max(0, min(event.x, self.canvas.winfo_width() - 1))
-        y = max(0, min(event.y, self.canvas.winfo_height() - 1))
-        
-        remote_x = x * (self.remote_width / self.canvas.winfo_width())
-        remote_y = y * (self.remote_height / self.canvas.winfo_height())
+        remote_x, remote_y = self.to_remote(event.x, event.y)
         
         if abs(remote_x - self.last_mouse_pos[0]) > self.mouse_threshold or abs(remote_y - self.last_mouse_pos[1]) > self.mouse_threshold:
-            self.send_message({
+            self.queue_input({
                 'type': 'mouse',
                 'data': {
                     'type': 'move',
-                    'x': int(remote_x),
-                    'y': int(remote_y)
+                    'x': remote_x,
+                    'y': remote_y
                 }
             })
             self.last_mouse_pos = (remote_x, remote_y)
@@ -163,40 +671,44 @@ class SecureClient:
     def on_mouse_button(self, event):
         if not self.conn:
             return
+        if self.selecting:
+            self.selection_start = (event.x, event.y)
+            return
         
         button = 'left' if event.num == 1 else 'right' if event.num == 3 else None
         if button:
-            x = event.x * (self.remote_width / self.canvas.winfo_width())
-            y = event.y * (self.remote_height / self.canvas.winfo_height())
+            x, y = self.to_remote(event.x, event.y)
             
-            self.send_message({
+            self.queue_input({
                 'type': 'mouse',
                 'data': {
                     'type': 'click',
                     'button': button,
                     'state': 'down',
-                    'x': int(x),
-                    'y': int(y)
+                    'x': x,
+                    'y': y
                 }
             })
     
     def on_mouse_release(self, event):
         if not self.conn:
             return
+        if self.selecting:
+            self.finish_selection(event)
+            return
         
         button = 'left' if event.num == 1 else 'right' if event.num == 3 else None
         if button:
-            x = event.x * (self.remote_width / self.canvas.winfo_width())
-            y = event.y * (self.remote_height / self.canvas.winfo_height())
+            x, y = self.to_remote(event.x, event.y)
             
-            self.send_message({
+            self.queue_input({
                 'type': 'mouse',
                 'data': {
                     'type': 'click',
                     'button': button,
                     'state': 'up',
-                    'x': int(x),
-                    'y': int(y)
+                    'x': x,
+                    'y': y
                 }
             })
     
@@ -204,7 +716,7 @@ class SecureClient:
         if not self.conn:
             return
         
-        self.send_message({
+        self.queue_input({
             'type': 'mouse',
             'data': {
                 'type': 'wheel',
@@ -218,7 +730,7 @@ class SecureClient:
         
         if event.keysym not in self.pressed_keys:
             self.pressed_keys.add(event.keysym)
-            self.send_message({
+            self.queue_input({
                 'type': 'keyboard',
                 'data': {
                     'key': event.keysym,
@@ -232,7 +744,7 @@ class SecureClient:
         
         if event.keysym in self.pressed_keys:
             self.pressed_keys.remove(event.keysym)
-            self.send_message({
+            self.queue_input({
                 'type': 'keyboard',
                 'data': {
                     'key': event.keysym,
@@ -240,48 +752,281 @@ class SecureClient:
                 }
             })
     
-    def update_screenshot(self):
-        while self.running:
-            try:
-                self.send_message({'type': 'screenshot'})
-                
-                size_data = self.conn.recv(8)
-                if not size_data:
+    def apply_frame(self, header, payload):
+        # Frames sent before the server saw our newest epoch must not touch the cache
+        cache = self.tile_cache if header.get('cache_epoch') == self.cache_epoch else None
+        self.framebuffer = apply_tiles(self.framebuffer, header, payload, cache)
+    
+    def reset_tile_cache(self):
+        self.tile_cache.clear()
+        self.cache_epoch += 1
+    
+    def tile_cache_lost(self, message):
+        # The server mirrors our cache from the frames it sent; one we could not apply puts them out of step
+        if message.get('cache_epoch') == self.cache_epoch:
+            self.reset_tile_cache()
+            self.run_in_ui(self.subscribe)
+    
+    def on_hello(self, message):
+        self.reconnect_delay = self.reconnect_min
+        self.set_server_codecs(message['codecs'])
+        if 'monitors' in message:
+            self.set_monitors(message['monitors'], message['desktop'])
+        self.send_viewport()
+        self.subscribe(resume=True)
+        self.transfers.resume()
+    
+    def update_screenshot(self, channel, frames, negotiated, stopped):
+        # Receive thread: only reads from the socket and hands frames to the decode worker
+        # Each connection's workers get their own channel and stop flag, so one that is slow to
+        # notice a disconnect never touches the next connection
+        try:
+            while not stopped.is_set():
+                message, payload = channel.recv()
+                if not message:
                     break
                 
-                size = int.from_bytes(size_data, byteorder='big')
+                if message['type'] == 'hello':
+                    # Use the first protocol we both speak, JSON framing is the fallback
+                    # Switch here, before the next read, so the reply is never parsed with the old framing
+                    offered = message.get('protocols', [PROTOCOL_JSON])
+                    channel.negotiate(next(p for p in PROTOCOLS if p in offered))
+                    negotiated.set()
+                    # TLS 1.3 tickets arrive after the handshake, so the session is saved once data flows
+                    self.tls_session = channel.sock.session
+                    self.run_in_ui(self.on_hello, message)
+                    continue
                 
-                data = b''
-                while len(data) < size:
-                    chunk = self.conn.recv(min(size - len(data), 8192))
-                    if not chunk:
-                        break
-                    data += chunk
+                if message['type'] in TRANSFER_MESSAGES:
+                    self.transfers.dispatch(message, payload)
+                    continue
                 
-                img = Image.open(io.BytesIO(data))
-                self.remote_width, self.remote_height = img.size
+                if message['type'] == 'listing':
+                    self.run_in_ui(self.browser.add_page, message)
+                    continue
                 
-                canvas_width = self.canvas.winfo_width()
-                canvas_height = self.canvas.winfo_height()
+                if message['type'] == 'thumbnail':
+                    # Small enough to decode here rather than queue behind frames
+                    try:
+                        image = decode_image(payload)
+                    finally:
+                        channel.release(payload)
+                    self.run_in_ui(self.show_thumbnail, image, message)
+                    continue
                 
-                scale = min(canvas_width/self.remote_width, canvas_height/self.remote_height)
+                if message['type'] == 'pong':
+                    self.on_pong(message)
+                    continue
                 
-                new_width = int(self.remote_width * scale)
-                new_height = int(self.remote_height * scale)
+                if message['type'] == 'stats':
+                    self.server_stats = message
+                    continue
                 
-                if new_width > 0 and new_height > 0:
-                    img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                    self.photo = ImageTk.PhotoImage(img)
-                    self.canvas.delete("all")
-                    self.canvas.create_image(canvas_width//2, canvas_height//2, image=self.photo, anchor=tk.CENTER)
+                if message['type'] != 'frame':
+                    continue
                 
-                self.root.after(self.screenshot_interval, self.update_screenshot)
-                break
+                received_at = time.perf_counter()
+                self.latency.record('receive', received_at - channel.header_at)
+                self.latency.record_bytes('frame_bytes', message['bytes'])
+                if self.clock_offset is not None and 'sent' in message:
+                    self.latency.record('network', time.time() - (message['sent'] - self.clock_offset))
+                
+                # Deltas build on each other, so every frame is decoded; only rendering drops frames
+                while not stopped.is_set():
+                    try:
+                        frames.put((message, payload, received_at), timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+        
+        except Exception as e:
+            if not stopped.is_set():
+                self.run_in_ui(self.connection_lost, f"Error updating screenshot: {e}", channel)
+            return
+        
+        if not stopped.is_set():
+            self.run_in_ui(self.connection_lost, "Server closed the connection", channel)
+    
+    def decode_loop(self, channel, send_queue, frames, mailbox, stopped):
+        while not stopped.is_set():
+            try:
+                message, payload, received_at = frames.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            
+            started = time.perf_counter()
+            self.latency.record('decode_queue', started - received_at)
+            try:
+                if message['keyframe']:
+                    self.keyframe_requested = False
+                elif self.framebuffer is None:
+                    self.request_keyframe()
+                    self.tile_cache_lost(message)
+                    continue
                 
+                self.apply_frame(message, payload)
+                self.frame_sequence = message.get('sequence')
+                self.latency.record('decode', time.perf_counter() - started)
             except Exception as e:
-                self.update_status(f"Error updating screenshot: {e}")
-                self.disconnect()
+                # The framebuffer may be half patched, start over from a keyframe
+                self.run_in_ui(self.update_status, f"Error decoding frame: {e}")
+                self.request_keyframe()
+                self.tile_cache_lost(message)
+                continue
+            finally:
+                # Tiles are decoded straight from the receive buffer, recycle it once pasted
+                channel.release(payload)
+                if 'frame_id' in message:
+                    # Acks are cumulative, a newer one replaces any still queued
+                    send_queue.put({'type': 'frame_ack', 'id': message['frame_id']}, PRIORITY_CONTROL, key='frame_ack')
+            
+            if frames.empty():
+                # Only scale the newest state, the UI would skip the intermediate ones anyway
+                started = time.perf_counter()
+                frame = self.render_frame(message)
+                ready_at = time.perf_counter()
+                self.latency.record('scale', ready_at - started)
+                mailbox.put(frame + (ready_at,))
+    
+    def render_frame(self, message):
+        # Runs on the decode worker, the result is independent of the framebuffer it came from
+        img = self.framebuffer
+        canvas_width, canvas_height = self.canvas_size
+        
+        # The server already scaled to our viewport; shrink if the canvas got smaller since, and
+        # stretch back up to no more than native size if rate control reduced the resolution
+        fit = min(canvas_width/img.width, canvas_height/img.height, 1.0 / message.get('scale', 1.0))
+        if fit != 1.0:
+            new_width = max(1, int(img.width * fit))
+            new_height = max(1, int(img.height * fit))
+            img = img.resize((new_width, new_height), Image.Resampling.BILINEAR)
+        else:
+            img = img.copy()
+        return img, message.get('scale', 1.0) * fit, message
+    
+    def blit_frame(self, frame):
+        img, scale, message, ready_at = frame
+        started = time.perf_counter()
+        self.latency.record('mailbox', started - ready_at)
+        canvas_width, canvas_height = self.canvas_size
+        self.remote_width = message.get('source_width', message['width'])
+        self.remote_height = message.get('source_height', message['height'])
+        self.remote_origin = (message.get('origin_x', 0), message.get('origin_y', 0))
+        self.display_scale = scale
+        self.display_offset = ((canvas_width - img.width) // 2, (canvas_height - img.height) // 2)
+        
+        # Reuse the Tk image while the size holds, a paste is cheaper than a new PhotoImage
+        if self.photo is None or (self.photo.width(), self.photo.height()) != img.size:
+            self.photo = ImageTk.PhotoImage(img)
+            self.canvas.delete("all")
+            self.canvas_image = self.canvas.create_image(canvas_width//2, canvas_height//2, image=self.photo, anchor=tk.CENTER)
+            self.draw_overlay()
+        else:
+            self.photo.paste(img)
+            self.canvas.coords(self.canvas_image, canvas_width//2, canvas_height//2)
+        status = (f"{message['codec']}: {message['bytes'] / 1024:.1f} KB, encoded in {message['encode_ms']:.1f} ms, "
+                  f"{self.mailbox.dropped} dropped")
+        rate = message.get('rate')
+        if rate:
+            status += (f" | auto {rate['fps']:.0f} fps, q{rate['quality']}, {rate['scale']:.0%} scale, "
+                       f"rtt {rate['rtt_ms']:.0f} ms, {rate['kbps']:.0f} kbps: {rate['reason']}")
+        self.update_status(status)
+        
+        self.latency.record('render', time.perf_counter() - started)
+        if self.clock_offset is not None and 'captured' in message:
+            self.latency.record('end_to_end', time.time() - (message['captured'] - self.clock_offset))
+    
+    def on_pong(self, message):
+        now = time.time()
+        rtt = now - message['time']
+        self.latency.record('rtt', rtt)
+        # The sample with the shortest round trip has the least queueing skewing its offset
+        self.clock_samples.append((rtt, message['server_time'] - (message['time'] + now) / 2))
+        self.rtt, self.clock_offset = min(self.clock_samples)
+    
+    def stats_tick(self):
+        self.root.after(1000, self.stats_tick)
+        now = time.perf_counter()
+        elapsed, self.stats_time = now - self.stats_time, now
+        stages = self.latency.snapshot(reset=True)
+        if not self.running:
+            return
+        
+        self.send_message({'type': 'ping', 'time': time.time()}, PRIORITY_CONTROL, key='ping')
+        if self.overlay_var.get() or self.stats_file:
+            self.send_message({'type': 'stats'}, PRIORITY_CONTROL, key='stats')
+        
+        fps = stages.get('render', {}).get('count', 0) / elapsed
+        bandwidth = stages.get('frame_bytes', {}).get('total', 0) / elapsed / 1024
+        # Hits and evictions match the server's mirror, only the server knows the bytes it did not send
+        tiles = dict(self.tile_cache.snapshot(), bytes_saved=(self.server_stats.get('tile_cache') or {}).get('bytes_saved', 0))
+        # Receive buffers of the current connection; allocations should stop once the pool has warmed up
+        buffers = self.channel.reader.pool.snapshot()
+        if self.stats_file:
+            self.stats_file.write(json.dumps({
+                'time': time.time(),
+                'interval_s': elapsed,
+                'fps': fps,
+                'kb_per_s': bandwidth,
+                'rtt_ms': self.rtt * 1000 if self.rtt is not None else None,
+                'dropped': self.mailbox.dropped,
+                'codec': self.codec_var.get(),
+                'tile_cache': tiles,
+                'buffers': buffers,
+                'client': stages,
+                'server': self.server_stats.get('stages', {})
+            }) + "\n")
+            self.stats_file.flush()
+        
+        server = self.server_stats.get('stages', {})
+        rtt = f"{self.rtt * 1000:.1f}" if self.rtt is not None else "-"
+        self.overlay_text = "\n".join([
+            f"{fps:.1f} fps  {bandwidth:.0f} KB/s  {self.mailbox.dropped} dropped",
+            f"latency p50 {stage_value(stages, 'end_to_end', 'p50_ms')} p99 {stage_value(stages, 'end_to_end', 'p99_ms')} ms  rtt {rtt} ms",
+            f"encode {stage_value(server, 'encode', 'p50_ms')}  network {stage_value(stages, 'network', 'p50_ms')}  "
+            f"receive {stage_value(stages, 'receive', 'p50_ms')}  "
+            f"decode {stage_value(stages, 'decode', 'p50_ms')}  scale {stage_value(stages, 'scale', 'p50_ms')}  render {stage_value(stages, 'render', 'p50_ms')} ms",
+            f"input flush {stage_value(stages, 'input_flush', 'p50_ms')}  network {stage_value(server, 'input_network', 'p50_ms')}  "
+            f"inject {stage_value(server, 'input_inject', 'p50_ms')}  total {stage_value(server, 'input_end_to_end', 'p50_ms')} ms",
+            f"tile cache {tiles['hit_rate']:.0%} hit  {tiles['bytes_saved'] / 1024:.0f} KB saved  "
+            f"{tiles['bytes'] / 1048576:.1f} MB  {tiles['evictions']} evicted",
+            f"receive buffers {buffers['allocated']} allocated  {buffers['reused']} reused"
+        ])
+        self.draw_overlay()
+    
+    def draw_overlay(self):
+        self.canvas.delete('overlay')
+        if self.overlay_var.get() and self.running:
+            self.canvas.create_text(8, 8, text=self.overlay_text, anchor=tk.NW, fill='yellow',
+                                    font=('Courier', 9), tags='overlay')
+    
+    def toggle_recording(self):
+        # Appends one JSON line of client and server stage stats per second, for comparing runs
+        if self.stats_file:
+            self.stats_file.close()
+            self.stats_file = None
+            self.record_button.config(text="Record Stats...")
+            return
+        path = filedialog.asksaveasfilename(title="Record stats to", defaultextension='.jsonl')
+        if path:
+            self.stats_file = open(path, 'a')
+            self.record_button.config(text="Stop Recording")
+    
+    def run_in_ui(self, callback, *args):
+        self.ui_calls.put((callback, args))
+    
+    def poll_ui(self):
+        while True:
+            try:
+                callback, args = self.ui_calls.get_nowait()
+            except queue.Empty:
                 break
+            callback(*args)
+        
+        frame = self.mailbox.take()
+        if frame is not None and self.running:
+            self.blit_frame(frame)
+        self.root.after(self.ui_poll_interval, self.poll_ui)
     
     def connect(self):
         try:
@@ -293,36 +1038,116 @@ class SecureClient:
             self.host, port = ngrok_url.split(":")
             self.port = int(port)
             
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.conn = self.context.wrap_socket(sock, server_hostname=self.host)
-            self.conn.connect((self.host, self.port))
-            
-            self.running = True
-            self.connect_button.config(text="Disconnect")
-            self.status_label.config(text="Connected")
-            self.update_status("Connected to server")
-            
-            self.screenshot_thread = threading.Thread(target=self.update_screenshot)
-            self.screenshot_thread.daemon = True
-            self.screenshot_thread.start()
-            
+            # A new session starts from a full keyframe; reconnects after a drop keep all of this
+            self.session_token = uuid.uuid4().hex
+            self.tls_session = None
+            self.framebuffer = None
+            self.frame_sequence = None
+            self.keyframe_requested = True
+            self.view_region = None
+            self.monitor_var.set('Default')
+            self.reconnect_delay = self.reconnect_min
+            self.open_connection()
+        
         except Exception as e:
             self.update_status(f"Connection error: {e}")
             self.disconnect()
     
-    def disconnect(self):
+    def open_connection(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+        try:
+            self.conn = self.context.wrap_socket(sock, server_hostname=self.host, session=self.tls_session)
+        except Exception:
+            sock.close()
+            raise
+        self.conn.settimeout(None)
+        self.channel = channel = Channel(self.conn)
+        self.reset_tile_cache()  # The new connection's stream starts with an empty mirror
+        self.send_queue = send_queue = SendQueue()
+        frames = queue.Queue(maxsize=4)
+        self.mailbox = mailbox = FrameMailbox()
+        self.stopped = stopped = threading.Event()
+        negotiated = threading.Event()  # Set once the hello exchange picked the framing
+        
+        self.clock_samples.clear()
+        self.clock_offset = None
+        self.rtt = None
+        self.running = True
+        self.connect_button.config(text="Disconnect")
+        self.status_label.config(text="Connected")
+        self.update_status("Reconnected to server (TLS session resumed)" if self.conn.session_reused else "Connected to server")
+        
+        self.screenshot_thread = threading.Thread(target=self.update_screenshot, args=(channel, frames, negotiated, stopped))
+        self.screenshot_thread.daemon = True
+        self.screenshot_thread.start()
+        
+        self.decode_thread = threading.Thread(target=self.decode_loop, args=(channel, send_queue, frames, mailbox, stopped))
+        self.decode_thread.daemon = True
+        self.decode_thread.start()
+        
+        self.writer_thread = threading.Thread(target=self.writer_loop, args=(channel, send_queue, negotiated, stopped))
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+    
+    def close_connection(self):
         self.running = False
+        if self.stopped:
+            self.stopped.set()
+        if self.flush_after_id:
+            self.root.after_cancel(self.flush_after_id)
+            self.flush_after_id = None
+        self.pending_input = []
+        self.pending_since = None
+        self.transfers.interrupt()
         if self.conn:
+            # close() alone does not wake a thread blocked reading the socket, shutdown does
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # Already dropped
             self.conn.close()
             self.conn = None
+        # The workers notice within their 0.5s poll; wait so none of them outlives into the next connection
+        for thread in (self.screenshot_thread, self.decode_thread, self.writer_thread):
+            if thread is not None and thread is not threading.current_thread():
+                thread.join(1.0)
+    
+    def connection_lost(self, reason, channel):
+        # UI thread; the framebuffer and session token are kept so the reconnect only needs a delta
+        if not self.running or channel is not self.channel:
+            return  # Reported by a worker of a connection that is already gone
+        self.close_connection()
+        self.schedule_reconnect(reason)
+    
+    def schedule_reconnect(self, reason):
+        self.status_label.config(text="Reconnecting")
+        self.update_status(f"{reason}; reconnecting in {self.reconnect_delay:.1f}s")
+        self.reconnect_after_id = self.root.after(int(self.reconnect_delay * 1000), self.reconnect)
+        self.reconnect_delay = min(self.reconnect_delay * 2, self.reconnect_max)
+    
+    def reconnect(self):
+        self.reconnect_after_id = None
+        try:
+            self.open_connection()
+        except Exception as e:
+            self.close_connection()
+            self.schedule_reconnect(f"Reconnect failed: {e}")
+    
+    def disconnect(self):
+        if self.reconnect_after_id:
+            self.root.after_cancel(self.reconnect_after_id)
+            self.reconnect_after_id = None
+        self.close_connection()
         
         self.connect_button.config(text="Connect")
         self.status_label.config(text="Disconnected")
         self.update_status("Disconnected from server")
         self.canvas.delete("all")
+        self.photo = None
+        self.canvas_image = None
     
     def toggle_connection(self):
-        if self.conn:
+        if self.conn or self.reconnect_after_id:
             self.disconnect()
         else:
             self.connect()
@@ -0,0 +1,147 @@
+import io
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from PIL import Image
+from frames import TILE_SIZE, encode_image, encode_tiles
+
+def split_boxes(boxes, workers, min_area=256 * 256):
+    # Cut large rects into horizontal bands so every worker gets a share of a keyframe
+    parts = []
+    for left, top, right, bottom in boxes:
+        height = bottom - top
+        if workers <= 1 or (right - left) * height < min_area:
+            parts.append((left, top, right, bottom))
+            continue
+        band = max(TILE_SIZE, math.ceil(height / workers / TILE_SIZE) * TILE_SIZE)
+        for band_top in range(top, bottom, band):
+            parts.append((left, band_top, right, min(band_top + band, bottom)))
+    return parts
+
+def encode_crop(image, box, codec, quality):
+    output = io.BytesIO()
+    encode_image(image.crop(box), output, codec, quality)
+    return output.getvalue()
+
+_attached = {}
+
+def encode_shared(name, width, box, codec, quality):
+    # Runs in a worker process; only the rows of this band are copied out of shared memory
+    memory = _attached.get(name)
+    if memory is None:
+        # Segments are reused frame after frame, so each worker attaches once
+        memory = _attached[name] = shared_memory.SharedMemory(name=name)
+    left, top, right, bottom = box
+    stride = width * 3
+    band = Image.frombuffer('RGB', (width, bottom - top), memory.buf[top * stride:bottom * stride], 'raw', 'RGB', 0, 1)
+    return encode_crop(band, (left, 0, right, bottom - top), codec, quality)
+
+class TileEncoderPool:
+    def __init__(self, workers=None, mode='thread'):
+        self.workers = workers or os.cpu_count() or 1
+        self.mode = mode
+        self.executor = None
+        if self.workers > 1:
+            # Pillow releases the GIL while compressing, so threads scale for most codecs
+            if mode == 'process':
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='encode')
+        self.lock = threading.Lock()
+        self.segments = []  # Reusable shared memory for process mode
+        self.closed = False
+    
+    def acquire_segment(self, size):
+        with self.lock:
+            for segment in self.segments:
+                if segment.size >= size:
+                    self.segments.remove(segment)
+                    return segment
+        return shared_memory.SharedMemory(create=True, size=size)
+    
+    def release_segment(self, segment):
+        with self.lock:
+            if not self.closed:
+                self.segments.append(segment)
+                return
+        # An encode that was still running when the pool closed
+        segment.close()
+        segment.unlink()
+    
+    def encode_tiles(self, frame, boxes, keyframe=False, codec='png', quality=85):
+        if self.executor is None:
+            return encode_tiles(frame, boxes, keyframe, codec, quality)
+        
+        started = time.perf_counter()
+        boxes = split_boxes(boxes, self.workers)
+        if self.mode == 'process':
+            if frame.mode != 'RGB':
+                frame = frame.convert('RGB')
+            raw = frame.tobytes()
+            segment = self.acquire_segment(len(raw))
+            try:
+                segment.buf[:len(raw)] = raw
+                chunks = list(self.executor.map(encode_shared, [segment.name] * len(boxes), [frame.width] * len(boxes),
+                                                boxes, [codec] * len(boxes), [quality] * len(boxes)))
+            finally:
+                self.release_segment(segment)
+        else:
+            chunks = list(self.executor.map(lambda box: encode_crop(frame, box, codec, quality), boxes))
+        
+        tiles = [[box[0], box[1], box[2] - box[0], box[3] - box[1], len(chunk)] for box, chunk in zip(boxes, chunks)]
+        header = {
+            'type': 'frame',
+            'keyframe': keyframe,
+            'width': frame.width,
+            'height': frame.height,
+            'codec': codec,
+            'encode_ms': (time.perf_counter() - started) * 1000,
+            'bytes': sum(len(chunk) for chunk in chunks),
+            'tiles': tiles
+        }
+        return header, b''.join(chunks)
+    
+    def close(self):
+        with self.lock:
+            self.closed = True
+            segments, self.segments = self.segments, []
+        if self.executor is not None:
+            self.executor.shutdown()
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+
+def benchmark(width=3840, height=2160, codec='png', quality=85, mode='thread', worker_counts=(1, 2, 4, 8), frames=5):
+    from capture import SyntheticSource
+    source = SyntheticSource(width, height, mode='video')
+    images = [source.grab() for _ in range(frames)]
+    box = [(0, 0, width, height)]
+    results = {}
+    for workers in worker_counts:
+        pool = TileEncoderPool(workers, mode)
+        pool.encode_tiles(images[0], box, True, codec, quality)  # Warm up the workers
+        started = time.perf_counter()
+        for image in images:
+            pool.encode_tiles(image, box, True, codec, quality)
+        results[workers] = (time.perf_counter() - started) / frames * 1000
+        pool.close()
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Measure keyframe encode time against worker count")
+    parser.add_argument('--width', type=int, default=3840)
+    parser.add_argument('--height', type=int, default=2160)
+    parser.add_argument('--codec', default='png')
+    parser.add_argument('--quality', type=int, default=85)
+    parser.add_argument('--mode', choices=['thread', 'process'], default='thread')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+    
+    results = benchmark(args.width, args.height, args.codec, args.quality, args.mode, args.workers)
+    baseline = results[args.workers[0]]
+    for workers, elapsed in results.items():
+        print(f"{workers} worker(s): {elapsed:.1f} ms/frame ({baseline / elapsed:.2f}x)")
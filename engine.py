@@ -0,0 +1,604 @@
+import asyncio
+import base64
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import StageLatency
+from frames import (FrameDiffer, TileCache, available_codecs, boxes_to_tiles, tiles_to_boxes, tile_grid, split_digests,
+                    RESAMPLING_FILTERS, TILE_SIZE)
+from broadcast import FrameProducer, Thumbnailer
+from capture import clamp_region
+from encoder import TileEncoderPool
+from protocol import AsyncChannel, PROTOCOLS, PROTOCOL_JSON
+from transfer import TransferManager, TRANSFER_MESSAGES
+from listing import DirectoryBrowser, DirectoryCache
+from ratecontrol import RateController
+
+class FrameStream:
+    def __init__(self, session):
+        self.session = session
+        self.producer = session.engine.producer
+        self.latency = session.latency
+        self.interval = 0.05
+        self.codec = 'png'
+        self.quality = 85
+        self.scale = 1.0
+        self.max_fps = 20  # Manual settings from the client, ceilings for the rate controller
+        self.max_quality = 85
+        self.controller = None  # Only for clients that acknowledge frames
+        self.resample = 'auto'
+        self.viewport = None  # Client canvas size, frames are downscaled to fit it
+        self.region = None  # Part of the desktop to stream, None for the capture source's default
+        self.group = None  # Shared encoder group for the current settings
+        self.cursor = None  # Sequence of the last frame sent from the group
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.keyframe_requested = True
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.parked = False  # Detached from a dropped session but still in its group
+        self.parked_at = 0  # Group sequence when parked
+        self.recent = {}  # Sequence -> tiles, for the frames in the history when parked
+        self.missed = set()  # Tiles changed since parking, None once only a keyframe will do
+        self.resumed = None  # (parked stream, sequence the client holds) until the first regroup
+        self.backlog = None  # Tiles a resumed client is missing, sent with the next frame
+        self.tile_cache = None  # Mirror of the client's tile cache, tracking digests and sizes only
+        self.cache_epoch = 0  # Bumped by the client whenever it empties its cache
+        self.cache_bytes_saved = 0
+    
+    def set_rate(self, fps):
+        self.max_fps = max(1, min(fps, 120))
+        self.apply_limits()
+    
+    def set_viewport(self, width, height):
+        self.viewport = (width, height) if width > 0 and height > 0 else None
+        self.regroup()
+    
+    def set_region(self, region, desktop):
+        # A region that fits the viewport streams at native resolution
+        self.region = clamp_region(region, desktop) if region else None
+        self.regroup()
+    
+    def set_tile_cache(self, settings):
+        # settings is {'max_bytes', 'epoch'} from the client, None when it keeps no cache
+        if not settings or settings.get('max_bytes', 0) <= 0:
+            self.tile_cache = None
+        elif (self.tile_cache is None or settings['epoch'] != self.cache_epoch or
+                settings['max_bytes'] != self.tile_cache.max_bytes):
+            self.tile_cache = TileCache(settings['max_bytes'])
+            self.cache_epoch = settings['epoch']
+    
+    def tile_cache_stats(self):
+        if self.tile_cache is None:
+            return None
+        return dict(self.tile_cache.snapshot(), epoch=self.cache_epoch, bytes_saved=self.cache_bytes_saved)
+    
+    async def use_tile_cache(self, group, frame):
+        # Tiles the client already holds go as references and only the rest is encoded, for this viewer alone
+        # Returns the frame to send, the (box, digest) tiles referenced and those the client will store
+        if frame.hashes is None:
+            return frame, [], []
+        tiles = list(zip(tile_grid(frame.header['tiles']), split_digests(frame.hashes)))
+        hits = [(box, digest) for box, digest in tiles if digest in self.tile_cache]
+        if not hits or frame.image is None:
+            return frame, [], tiles
+        
+        digests = {box[:2]: digest for box, digest in tiles}
+        misses = {(box[0] // TILE_SIZE, box[1] // TILE_SIZE) for box, digest in tiles if digest not in self.tile_cache}
+        boxes = tiles_to_boxes(misses, frame.image.width, frame.image.height)
+        loop = asyncio.get_running_loop()
+        reduced = await loop.run_in_executor(self.producer.executor, group.encode_region, frame.image, frame.sequence,
+                                             frame.captured_at, frame.header, boxes, frame.keyframe)
+        if 'copies' in frame.header:
+            reduced.header['copies'] = frame.header['copies']
+        return reduced, hits, [(box, digests[box[:2]]) for box in tile_grid(reduced.header['tiles'])]
+    
+    def resampling_filter(self):
+        if self.resample in RESAMPLING_FILTERS:
+            return self.resample
+        # Favour a fast filter once the frame budget gets tight; rate control moving fps does not regroup
+        return 'bilinear' if self.max_fps >= 30 else 'lanczos'
+    
+    def set_encoding(self, codec, quality, resample='auto'):
+        self.resample = resample
+        self.codec = codec
+        self.max_quality = max(1, min(int(quality), 100))
+        self.apply_limits()
+    
+    def set_adaptive(self, enabled, budget=0.15):
+        if not enabled:
+            self.controller = None
+        elif self.controller is None:
+            self.controller = RateController(budget)
+        else:
+            self.controller.budget = budget
+    
+    def apply_limits(self):
+        fps, quality, scale = self.max_fps, self.max_quality, 1.0
+        if self.controller is not None:
+            fps, quality, scale = self.controller.limit(self.max_fps, self.max_quality)
+        self.interval = 1.0 / fps
+        self.quality = quality
+        self.scale = scale
+        self.regroup()
+    
+    def on_ack(self, frame_id):
+        if self.controller is not None:
+            self.controller.on_ack(frame_id, time.perf_counter())
+            self.wakeup.set()  # Room may have opened up for a frame that was held back
+    
+    def request_keyframe(self):
+        self.keyframe_requested = True
+        self.wakeup.set()
+    
+    def regroup(self):
+        if self.task is None:
+            return
+        
+        key = (self.codec, self.quality, self.viewport, self.resampling_filter(), self.scale, self.region)
+        if self.group is not None and self.group.key == key:
+            return
+        
+        if self.group is not None:
+            self.producer.leave(self, self.group)
+        self.group = self.producer.join(self, key)
+        # Sequences of different groups do not line up, start the new one from a keyframe
+        self.cursor = None
+        if self.resumed is not None:
+            parked, sequence = self.resumed
+            self.resumed = None
+            tiles = parked.resume_tiles(sequence) if self.group is parked.group else None
+            if tiles is not None:
+                # The client still holds that frame, a delta of everything changed since brings it up to date
+                self.cursor = self.group.sequence
+                self.backlog = tiles
+            parked.parked = False
+            parked.stop()
+        self.wakeup.set()
+    
+    def start(self, fps):
+        if self.task is None:
+            self.task = asyncio.create_task(self.send_loop())
+        self.set_rate(fps)
+    
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.group is not None and not self.parked:
+            self.producer.leave(self, self.group)
+            self.group = None
+    
+    def detach(self):
+        # Staying in the group keeps its sequence numbers going and lets it track what changed meanwhile
+        group = self.group
+        self.parked = True
+        self.parked_at = group.sequence
+        self.recent = {frame.sequence: None if frame.keyframe else boxes_to_tiles(frame.changed) for frame in group.frames}
+        self.missed = set()
+        self.stop()
+    
+    def note_missed(self, keyframe, boxes):
+        if self.missed is not None:
+            self.missed = None if keyframe else self.missed | boxes_to_tiles(boxes)
+    
+    def resume_tiles(self, sequence):
+        # Every tile changed after the given frame, or None if that can no longer be worked out
+        if self.missed is None or sequence > self.parked_at:
+            return None
+        tiles = set(self.missed)
+        for missed in range(sequence + 1, self.parked_at + 1):
+            if self.recent.get(missed) is None:
+                return None
+            tiles |= self.recent[missed]
+        return tiles
+    
+    def resume(self, parked, sequence):
+        # Takes over a dropped session's stream, starting from the frame its client last decoded
+        self.controller = parked.controller
+        if self.controller is not None:
+            self.controller.reset()
+        self.keyframe_requested = False
+        self.resumed = (parked, sequence)
+    
+    def ready(self):
+        group = self.group
+        return group is not None and group.sequence > 0 and (
+            self.keyframe_requested or self.cursor is None or group.sequence > self.cursor or bool(self.backlog))
+    
+    async def send_loop(self):
+        try:
+            while True:
+                if not self.ready():
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                
+                controller = self.controller
+                if controller is not None and not controller.may_send(time.perf_counter()):
+                    # The link has a budget's worth in flight; wait for an ack and send the newest frame then
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), controller.budget)
+                    except asyncio.TimeoutError:
+                        pass
+                    self.adapt()
+                    continue
+                
+                group = self.group
+                backlog, self.backlog = self.backlog, None
+                frame = await group.frame_for(self.cursor, self.keyframe_requested, backlog)
+                cache, hits, stored = self.tile_cache, [], []
+                if cache is not None:
+                    shared_size = len(frame.payload)
+                    frame, hits, stored = await self.use_tile_cache(group, frame)
+                if group is not self.group or cache is not self.tile_cache:
+                    continue  # Settings changed while the frame was being prepared
+                
+                # Frames published while this viewer was busy are skipped, not queued
+                if self.cursor is not None:
+                    self.frames_dropped += max(0, frame.sequence - self.cursor - 1)
+                if frame.keyframe:
+                    self.keyframe_requested = False
+                self.cursor = frame.sequence
+                
+                started = time.perf_counter()
+                self.latency.record('frame_age', started - frame.captured_at)
+                self.latency.record_bytes('frame_bytes', len(frame.payload))
+                # Wall clock stamps let the client work out end-to-end latency against its own clock
+                now = time.time()
+                header = dict(frame.header, sequence=frame.sequence, dropped=self.frames_dropped,
+                              captured=now - (started - frame.captured_at), sent=now)
+                if cache is not None:
+                    # The client replays these calls on its own cache, so both stay in step
+                    header['cache_epoch'] = self.cache_epoch
+                    if hits:
+                        header['cached'] = [[box[0], box[1], base64.b64encode(digest).decode()] for box, digest in hits]
+                        self.cache_bytes_saved += shared_size - len(frame.payload) - len(json.dumps(header['cached']))
+                    if stored:
+                        header['hashes'] = base64.b64encode(b''.join(digest for _, digest in stored)).decode()
+                    for _, digest in hits:
+                        cache.get(digest)
+                    for (left, top, right, bottom), digest in stored:
+                        cache.put(digest, None, (right - left) * (bottom - top) * 3)
+                if controller is not None:
+                    # The client acknowledges frame_id once the frame is decoded
+                    header['frame_id'] = self.frames_sent
+                    header['rate'] = controller.state(started)
+                    controller.on_send(self.frames_sent, len(frame.payload), started)
+                await self.session.channel.send(header, frame.payload)
+                self.latency.record('send', time.perf_counter() - started)
+                self.frames_sent += 1
+                self.adapt()
+                
+                # Viewers asking for fewer frames than the producer captures pace themselves
+                delay = self.interval - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error streaming frames: {e}")
+            self.session.close()
+    
+    def adapt(self):
+        if self.controller is not None and self.controller.update(time.perf_counter()):
+            self.apply_limits()
+
+class Session:
+    def __init__(self, engine, reader, writer):
+        self.engine = engine
+        self.writer = writer
+        self.addr = writer.get_extra_info('peername')
+        self.channel = AsyncChannel(reader, writer)
+        self.differ = FrameDiffer()
+        self.latency = StageLatency()
+        self.stream = FrameStream(self)
+        self.transfers = TransferManager(self.channel, engine.file_executor, engine.file_access)
+        self.browser = DirectoryBrowser(self.channel, engine.file_executor, engine.directory_cache,
+                                        engine.file_access, engine.filter_listing)
+        self.input_queue = asyncio.Queue()
+        self.tasks = set()
+        self.task = None
+        self.token = None  # Chosen by the client, lets a reconnect pick up this session's stream
+        self.thumbnail_task = None
+        self.thumbnail_interval = 0
+        self.desktop = None  # As last sent to the client, regions are clamped to it
+    
+    def spawn(self, stage, work, *args):
+        # Blocking work runs in an executor so the receive loop only parses and dispatches
+        task = asyncio.create_task(self.run_work(stage, time.perf_counter(), work, *args))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    
+    async def run_work(self, stage, queued_at, work, *args):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        self.latency.record(f'{stage}_queue', started - queued_at)
+        try:
+            message, payload = await loop.run_in_executor(self.engine.capture_executor, work, *args)
+            await self.channel.send(message, payload)
+        except Exception as e:
+            print(f"Error running {stage}: {e}")
+        self.latency.record(stage, time.perf_counter() - started)
+    
+    def screenshot(self, keyframe):
+        # Send only the tiles that changed since the last frame
+        return self.differ.encode(self.engine.source.grab(), keyframe=keyframe)
+    
+    def set_thumbnails(self, interval):
+        if interval == self.thumbnail_interval:
+            return
+        self.thumbnail_interval = interval
+        if self.thumbnail_task is not None:
+            self.thumbnail_task.cancel()
+            self.thumbnail_task = None
+        if interval > 0:
+            self.thumbnail_task = asyncio.create_task(self.thumbnail_loop(interval))
+            self.tasks.add(self.thumbnail_task)
+            self.thumbnail_task.add_done_callback(self.tasks.discard)
+    
+    async def thumbnail_loop(self, interval):
+        while True:
+            try:
+                header, payload = await self.engine.thumbnails.get(interval)
+                self.desktop = header['desktop']
+                await self.channel.send(header, payload)
+            except asyncio.CancelledError:
+                raise
+            except ConnectionError:
+                return  # The receive loop sees the connection go and cleans up
+            except Exception as e:
+                print(f"Error sending thumbnail: {e}")
+            await asyncio.sleep(interval)
+    
+    def file_access(self, path):
+        return {'type': 'file_access', 'allowed': self.engine.file_access(path)}, None
+    
+    async def input_loop(self):
+        # One shared injection thread keeps input ordered and never waits behind capture or encode
+        loop = asyncio.get_running_loop()
+        while True:
+            queued_at, message = await self.input_queue.get()
+            started = time.perf_counter()
+            self.latency.record('input_queue', started - queued_at)
+            try:
+                await loop.run_in_executor(self.engine.input_executor, self.engine.inject, message)
+            except Exception as e:
+                print(f"Error injecting input: {e}")
+            self.latency.record('input_inject', time.perf_counter() - started)
+            if 'sent' in message:
+                # From the client's flush to the events being injected, over the synced clock
+                self.latency.record('input_end_to_end', time.time() - message['sent'])
+    
+    async def layout(self):
+        # Sources such as ImageGrab only learn the desktop size by grabbing it, so never on the loop
+        source = self.engine.source
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.engine.capture_executor, lambda: (source.monitors(), source.desktop()))
+    
+    def close(self):
+        self.stream.stop()
+        self.writer.close()
+    
+    async def run(self):
+        codecs = self.engine.codecs
+        input_task = asyncio.create_task(self.input_loop())
+        self.tasks.add(input_task)
+        input_task.add_done_callback(self.tasks.discard)
+        try:
+            # Advertise what this server can encode and speak; the client picks per stream
+            monitors, self.desktop = await self.layout()
+            await self.channel.send({'type': 'hello', 'codecs': codecs, 'protocols': PROTOCOLS,
+                                     'monitors': monitors, 'desktop': self.desktop})
+            
+            while True:
+                message, payload = await self.channel.recv()
+                if not message:
+                    break
+                
+                if message['type'] in ('mouse', 'keyboard', 'batch'):
+                    if 'sent' in message:
+                        self.latency.record('input_network', time.time() - message['sent'])
+                    self.input_queue.put_nowait((time.perf_counter(), message))
+                elif message['type'] == 'hello':
+                    # Clients that never send a hello keep the legacy JSON framing
+                    protocol = message.get('protocol', PROTOCOL_JSON)
+                    if protocol in PROTOCOLS:
+                        self.channel.set_protocol(protocol)
+                elif message['type'] == 'screenshot':
+                    self.spawn('screenshot', self.screenshot, message.get('keyframe', False))
+                elif message['type'] == 'subscribe':
+                    # Push frames on the server's capture clock; resubscribing retargets the rate
+                    codec = message.get('codec', 'png')
+                    if codec not in codecs:
+                        codec = 'png'
+                    self.token = message.get('session', self.token)
+                    if 'resume' in message:
+                        parked = self.engine.unpark(self.token, self)
+                        if parked is not None:
+                            self.stream.resume(parked, message['resume'])
+                    self.stream.set_adaptive(message.get('adaptive', False), message.get('budget_ms', 150) / 1000)
+                    # Clamped to the layout the client last saw, the receive loop never waits on a grab
+                    self.stream.set_region(message.get('region'), self.desktop)
+                    self.stream.set_tile_cache(message.get('tile_cache'))
+                    self.stream.set_encoding(codec, message.get('quality', 85), message.get('filter', 'auto'))
+                    if message.get('keyframe'):
+                        self.stream.request_keyframe()
+                    self.stream.start(message.get('fps', 20))
+                    self.set_thumbnails(message.get('thumbnail', 0))
+                elif message['type'] == 'viewport':
+                    self.stream.set_viewport(message['width'], message['height'])
+                elif message['type'] == 'keyframe':
+                    self.stream.request_keyframe()
+                elif message['type'] == 'frame_ack':
+                    self.stream.on_ack(message['id'])
+                elif message['type'] == 'ping':
+                    # Clients estimate round trip time and clock offset from these
+                    await self.channel.send({'type': 'pong', 'time': message['time'], 'server_time': time.time()})
+                elif message['type'] == 'stats':
+                    stages = dict(self.engine.latency.snapshot(), **self.latency.snapshot())
+                    await self.channel.send({'type': 'stats', 'stages': stages,
+                                             'directory_cache': self.engine.directory_cache.snapshot(),
+                                             'tile_cache': self.stream.tile_cache_stats()})
+                elif message['type'] == 'file_access':
+                    # Check if file access is allowed
+                    self.spawn('file_access', self.file_access, message['data']['path'])
+                elif message['type'] in TRANSFER_MESSAGES:
+                    self.transfers.handle(message, payload)
+                elif message['type'] == 'browse':
+                    self.browser.handle(message)
+        except Exception as e:
+            print(f"Error handling client {self.addr}: {e}")
+        finally:
+            if self.token and self.stream.group is not None and not self.engine.stopping.is_set():
+                self.engine.park(self.token, self.stream)
+            else:
+                self.stream.stop()
+            self.transfers.close()
+            self.browser.close()
+            for task in list(self.tasks):
+                task.cancel()
+            self.close()
+
+class AsyncEngine:
+    def __init__(self, context, source, inject, file_access, host='0.0.0.0', port=4443,
+                 backlog=128, handshake_timeout=10.0, encode_workers=None, encode_mode='thread',
+                 filter_listing=None, input_initializer=None, on_status=None, resume_grace=30.0):
+        self.context = context
+        self.source = source
+        self.inject = inject
+        self.file_access = file_access
+        # Checks a whole directory listing at once, falling back to one file_access call per entry
+        self.filter_listing = filter_listing or (
+            lambda directory, names: [not file_access(os.path.join(directory, name)) for name in names])
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.handshake_timeout = handshake_timeout
+        self.on_status = on_status or (lambda text: None)
+        self.codecs = available_codecs()
+        
+        # Capture, encode and injection block, so they run in executors instead of per-socket threads
+        self.input_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='input',
+                                                 initializer=input_initializer)
+        self.capture_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4,
+                                                   thread_name_prefix='capture')
+        self.file_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='file')
+        self.directory_cache = DirectoryCache()
+        
+        # Large updates are split into bands and encoded in parallel on a separate pool, built per run
+        self.encode_workers = encode_workers
+        self.encode_mode = encode_mode
+        self.encoder = None
+        
+        # Frames are captured and encoded once, then fanned out to every viewer
+        self.latency = StageLatency()
+        self.producer = FrameProducer(source, self.capture_executor, self.latency, self.encoder)
+        self.thumbnails = Thumbnailer(source, self.capture_executor, 'jpeg' if 'jpeg' in self.codecs else 'png')
+        
+        self.sessions = set()
+        self.parked = {}  # Resume token -> (stream of a dropped session, expiry handle)
+        self.resume_grace = resume_grace
+        self.loop = None
+        self.stopping = None
+        self.thread = None
+        self.ready = threading.Event()  # Set once listening (or failed to), port then holds the bound port
+    
+    def update_status(self):
+        if self.sessions:
+            self.on_status(f"{len(self.sessions)} session(s) connected")
+        else:
+            self.on_status("Waiting for connection")
+    
+    def park(self, token, stream):
+        previous = self.parked.pop(token, None)
+        if previous is not None:
+            previous[1].cancel()
+            self.expire(token, previous[0])
+        stream.detach()
+        self.parked[token] = (stream, self.loop.call_later(self.resume_grace, self.expire, token, stream))
+    
+    def unpark(self, token, session):
+        parked = self.parked.pop(token, None)
+        if parked is not None:
+            parked[1].cancel()
+            return parked[0]
+        
+        # The dropped connection may not have been noticed yet, take its stream over
+        for other in self.sessions:
+            if other is not session and other.token == token and other.stream.group is not None:
+                other.token = None
+                other.stream.detach()
+                other.close()
+                return other.stream
+        return None
+    
+    def expire(self, token, stream):
+        if self.parked.get(token, (None,))[0] is stream:
+            del self.parked[token]
+        stream.parked = False
+        stream.stop()
+    
+    async def handle_connection(self, reader, writer):
+        # The TLS handshake has already completed, off the loop's critical path, by the time we get here
+        session = Session(self, reader, writer)
+        session.task = asyncio.current_task()
+        self.sessions.add(session)
+        self.update_status()
+        try:
+            await session.run()
+        except asyncio.CancelledError:
+            pass  # Only serve() cancels it, when stopping; asyncio's stream callback logs a cancelled handler as an error
+        finally:
+            self.sessions.discard(session)
+            self.update_status()
+    
+    async def serve(self):
+        self.ready.clear()
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        # The pool is shut down when a run ends, so a restarted engine needs a new one
+        self.encoder = self.producer.encoder = TileEncoderPool(self.encode_workers, self.encode_mode)
+        try:
+            try:
+                server = await asyncio.start_server(
+                    self.handle_connection, self.host, self.port, ssl=self.context,
+                    backlog=self.backlog, ssl_handshake_timeout=self.handshake_timeout,
+                    reuse_address=True)
+            except OSError as e:
+                self.on_status(f"Error starting server: {e}")
+                self.ready.set()
+                return
+            self.port = server.sockets[0].getsockname()[1]
+            self.ready.set()
+            self.update_status()
+            
+            async with server:
+                await self.stopping.wait()
+                sessions = list(self.sessions)
+                for session in sessions:
+                    session.close()
+                if sessions:
+                    done, pending = await asyncio.wait([session.task for session in sessions], timeout=2)
+                    # Anything still running is cancelled and awaited here, before asyncio.run closes the loop under it
+                    pending |= {task for session in sessions for task in session.tasks}
+                    for task in pending:
+                        task.cancel()
+                    await asyncio.gather(*pending, return_exceptions=True)
+                for token, (stream, handle) in list(self.parked.items()):
+                    handle.cancel()
+                    self.expire(token, stream)
+        finally:
+            self.encoder.close()
+    
+    def start(self):
+        self.ready.clear()  # Callers wait on it straight after start, before serve has run
+        self.thread = threading.Thread(target=asyncio.run, args=(self.serve(),), daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        if self.loop and self.stopping:
+            self.loop.call_soon_threadsafe(self.stopping.set)
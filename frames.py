@@ -0,0 +1,235 @@
+import base64
+import collections
+import hashlib
+import io
+import time
+from PIL import Image, ImageChops, features
+from framing import ViewStream
+
+def available_codecs():
+    codecs = ['png']
+    if features.check('jpg'):
+        codecs.append('jpeg')
+    if features.check('webp'):
+        codecs.extend(['webp', 'webp_lossless'])
+    return codecs
+
+def encode_image(image, output, codec='png', quality=85):
+    if codec == 'jpeg':
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.save(output, format='JPEG', quality=quality)
+    elif codec == 'webp':
+        image.save(output, format='WEBP', quality=quality, method=0)
+    elif codec == 'webp_lossless':
+        image.save(output, format='WEBP', lossless=True, quality=quality, method=0)
+    else:
+        image.save(output, format='PNG')
+
+RESAMPLING_FILTERS = {
+    'nearest': Image.Resampling.NEAREST,
+    'box': Image.Resampling.BOX,
+    'bilinear': Image.Resampling.BILINEAR,
+    'bicubic': Image.Resampling.BICUBIC,
+    'lanczos': Image.Resampling.LANCZOS
+}
+
+def scale_to_viewport(frame, viewport, resample='bilinear', limit=1.0):
+    # Only ever downscale; a viewport larger than the screen gets native pixels
+    scale = min(viewport[0] / frame.width, viewport[1] / frame.height, 1.0) if viewport else 1.0
+    scale *= limit  # Further reduction asked for by rate control
+    if scale >= 1.0:
+        return frame, 1.0
+    
+    size = (max(1, int(frame.width * scale)), max(1, int(frame.height * scale)))
+    return frame.resize(size, RESAMPLING_FILTERS[resample], reducing_gap=2.0), scale
+
+TILE_SIZE = 64
+
+def dirty_tiles(previous, frame, tile_size=TILE_SIZE, diff=None):
+    # Set of (column, row) tiles that differ between two frames of the same size
+    if diff is None:
+        diff = ImageChops.difference(previous, frame)
+    bbox = diff.getbbox()
+    if bbox is None:
+        return set()
+    
+    left, top, right, bottom = bbox
+    tiles = set()
+    for y in range(top - top % tile_size, bottom, tile_size):
+        for x in range(left - left % tile_size, right, tile_size):
+            box = (x, y, min(x + tile_size, frame.width), min(y + tile_size, frame.height))
+            if diff.crop(box).getbbox():
+                tiles.add((x // tile_size, y // tile_size))
+    return tiles
+
+def tiles_to_boxes(tiles, width, height, tile_size=TILE_SIZE):
+    # Adjacent dirty tiles in a row are merged into one rect
+    boxes = []
+    for row in sorted({row for _, row in tiles}):
+        columns = sorted(column for column, tile_row in tiles if tile_row == row)
+        top, bottom = row * tile_size, min((row + 1) * tile_size, height)
+        start = previous = columns[0]
+        for column in columns[1:] + [None]:
+            if column is not None and column == previous + 1:
+                previous = column
+                continue
+            boxes.append((start * tile_size, top, min((previous + 1) * tile_size, width), bottom))
+            start = previous = column
+    return boxes
+
+def boxes_to_tiles(boxes, tile_size=TILE_SIZE):
+    tiles = set()
+    for left, top, right, bottom in boxes:
+        for row in range(top // tile_size, (bottom - 1) // tile_size + 1):
+            for column in range(left // tile_size, (right - 1) // tile_size + 1):
+                tiles.add((column, row))
+    return tiles
+
+def encode_tiles(frame, boxes, keyframe=False, codec='png', quality=85):
+    started = time.perf_counter()
+    payload = io.BytesIO()
+    tiles = []
+    for box in boxes:
+        start = payload.tell()
+        encode_image(frame.crop(box), payload, codec, quality)
+        tiles.append([box[0], box[1], box[2] - box[0], box[3] - box[1], payload.tell() - start])
+    
+    header = {
+        'type': 'frame',
+        'keyframe': keyframe,
+        'width': frame.width,
+        'height': frame.height,
+        'codec': codec,
+        'encode_ms': (time.perf_counter() - started) * 1000,
+        'bytes': payload.tell(),
+        'tiles': tiles
+    }
+    return header, payload.getvalue()
+
+def apply_copies(image, copies):
+    # Each copy is [x, y, width, height, dx, dy]: the rect at (x, y) moves by (dx, dy), in place
+    for x, y, width, height, dx, dy in copies:
+        image.paste(image.crop((x, y, x + width, y + height)), (x + dx, y + dy))
+
+def copy_targets(copies):
+    return [(x + dx, y + dy, x + dx + width, y + dy + height) for x, y, width, height, dx, dy in copies]
+
+DIGEST_SIZE = 8
+
+def tile_grid(tiles, tile_size=TILE_SIZE):
+    # Grid tiles covering a frame's encoded rects, in the order their digests are listed
+    for x, y, width, height, _ in tiles:
+        for top in range(y, y + height, tile_size):
+            for left in range(x, x + width, tile_size):
+                yield (left, top, min(left + tile_size, x + width), min(top + tile_size, y + height))
+
+def hash_tiles(image, tiles, salt=b''):
+    # Content digests of the grid tiles; the salt keeps tiles encoded with other settings apart
+    digests = bytearray()
+    for box in tile_grid(tiles):
+        tile = image.crop(box)
+        digest = hashlib.blake2b(b'%dx%d:' % tile.size, digest_size=DIGEST_SIZE, key=salt)
+        digest.update(tile.tobytes())
+        digests += digest.digest()
+    return bytes(digests)
+
+def split_digests(digests):
+    return [digests[start:start + DIGEST_SIZE] for start in range(0, len(digests), DIGEST_SIZE)]
+
+class TileCache:
+    # Decoded tiles by content digest, least recently used evicted past max_bytes. The server keeps a
+    # mirror without the pixels; as both make the same calls in the same order they evict the same tiles.
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.tiles = collections.OrderedDict()  # Digest -> (tile, size)
+        self.bytes = 0
+        self.hits = 0  # Tiles reused from the cache
+        self.misses = 0  # Tiles that arrived as image data
+        self.evictions = 0
+    
+    def __contains__(self, digest):
+        return digest in self.tiles
+    
+    def get(self, digest):
+        tile, _ = self.tiles[digest]
+        self.tiles.move_to_end(digest)
+        self.hits += 1
+        return tile
+    
+    def put(self, digest, tile, size):
+        self.misses += 1
+        if size > self.max_bytes:
+            return
+        previous = self.tiles.pop(digest, None)
+        if previous is not None:
+            self.bytes -= previous[1]
+        self.tiles[digest] = (tile, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted) = self.tiles.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+    
+    def clear(self):
+        self.tiles.clear()
+        self.bytes = 0
+    
+    def snapshot(self):
+        looked_up = self.hits + self.misses
+        return {'tiles': len(self.tiles), 'bytes': self.bytes, 'max_bytes': self.max_bytes, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hits / looked_up if looked_up else 0.0,
+                'evictions': self.evictions}
+
+def apply_tiles(framebuffer, header, payload, cache=None):
+    # Client side of encode_tiles: patch the tiles into the framebuffer, starting afresh on keyframes
+    size = (header['width'], header['height'])
+    if header['keyframe'] or framebuffer is None or framebuffer.size != size:
+        framebuffer = Image.new('RGB', size)
+    
+    # Scrolled content is moved first, the tiles then fill in what it uncovered
+    apply_copies(framebuffer, header.get('copies', ()))
+    
+    # Tiles the server knows we hold come as references; a missing one means the caches went out of step
+    cached = header.get('cached')
+    if cached and cache is None:
+        raise KeyError("Frame refers to cached tiles but the tile cache was reset")
+    for x, y, digest in cached or ():
+        framebuffer.paste(cache.get(base64.b64decode(digest)), (x, y))
+    
+    offset = 0
+    for x, y, width, height, length in header['tiles']:
+        tile = Image.open(ViewStream(payload[offset:offset + length]))
+        framebuffer.paste(tile, (x, y))
+        offset += length
+    
+    if cache is not None and 'hashes' in header:
+        for box, digest in zip(tile_grid(header['tiles']), split_digests(base64.b64decode(header['hashes']))):
+            tile = framebuffer.crop(box)
+            cache.put(digest, tile, tile.width * tile.height * 3)
+    return framebuffer
+
+def decode_image(payload):
+    # For whole images such as thumbnails; loaded straight away so the payload buffer can be recycled
+    image = Image.open(ViewStream(payload))
+    image.load()
+    return image
+
+class FrameDiffer:
+    def __init__(self, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.previous = None  # Last frame sent to this client
+    
+    def changed_tiles(self, frame):
+        tiles = dirty_tiles(self.previous, frame, self.tile_size)
+        return tiles_to_boxes(tiles, frame.width, frame.height, self.tile_size)
+    
+    def encode(self, frame, keyframe=False, codec='png', quality=85):
+        keyframe = keyframe or self.previous is None or self.previous.size != frame.size
+        if keyframe:
+            boxes = [(0, 0, frame.width, frame.height)]
+        else:
+            boxes = self.changed_tiles(frame)
+        
+        self.previous = frame
+        return encode_tiles(frame, boxes, keyframe, codec, quality)
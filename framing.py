@@ -0,0 +1,103 @@
+import io
+import threading
+
+def recv_exact_into(sock, view):
+    # recv may return fewer bytes than asked for, keep filling until the view is full
+    while len(view):
+        received = sock.recv_into(view)
+        if not received:
+            return False
+        view = view[received:]
+    return True
+
+class BufferPool:
+    def __init__(self, max_buffers=4, max_buffer_size=64 * 1024 * 1024):
+        self.max_buffers = max_buffers
+        self.max_buffer_size = max_buffer_size
+        self.lock = threading.Lock()
+        self.free = []
+        self.allocated = 0
+        self.reused = 0
+    
+    def acquire(self, size):
+        with self.lock:
+            fitting = [buffer for buffer in self.free if len(buffer) >= size]
+            if fitting:
+                buffer = min(fitting, key=len)
+                self.free.remove(buffer)
+                self.reused += 1
+                return buffer
+            self.allocated += 1
+        
+        # Round up so slowly growing frames do not allocate on every read
+        capacity = 4096
+        while capacity < size:
+            capacity *= 2
+        return bytearray(capacity)
+    
+    def release(self, buffer):
+        if len(buffer) > self.max_buffer_size:
+            return
+        with self.lock:
+            if len(self.free) < self.max_buffers:
+                self.free.append(buffer)
+    
+    def snapshot(self):
+        with self.lock:
+            return {'allocated': self.allocated, 'reused': self.reused, 'free': len(self.free)}
+
+class ViewStream(io.RawIOBase):
+    # Read-only file object over a memoryview so decoders do not copy the payload first
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self.view) - self.position)
+        if size <= 0:
+            return 0
+        buffer[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = max(0, offset)
+        return self.position
+    
+    def tell(self):
+        return self.position
+
+class FrameReader:
+    def __init__(self, sock, pool=None):
+        self.sock = sock
+        self.pool = pool or BufferPool()
+    
+    def read_into(self, buffer):
+        return recv_exact_into(self.sock, memoryview(buffer))
+    
+    def read(self, size):
+        # The returned view is backed by a pooled buffer, hand it back with release()
+        buffer = self.pool.acquire(size)
+        view = memoryview(buffer)[:size]
+        if not recv_exact_into(self.sock, view):
+            view.release()
+            self.pool.release(buffer)
+            return None
+        return view
+    
+    def release(self, view):
+        if view is None:
+            return
+        buffer = view.obj
+        view.release()
+        self.pool.release(buffer)
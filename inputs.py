@@ -0,0 +1,114 @@
+import importlib.util
+import sys
+
+class InputSink:
+    # Applies remote mouse and keyboard messages to the local desktop
+    name = 'base'
+    
+    def __init__(self):
+        self.enabled = True
+    
+    def inject(self, message):
+        if not self.enabled:
+            return
+        if message['type'] == 'mouse':
+            self.mouse(message['data'])
+        elif message['type'] == 'keyboard':
+            self.key(message['data'])
+        elif message['type'] == 'batch':
+            # Coalesced input from one client flush tick, applied in order
+            for event in message['events']:
+                self.inject(event)
+    
+    def mouse(self, data):
+        raise NotImplementedError
+    
+    def key(self, data):
+        raise NotImplementedError
+    
+    def thread_initializer(self):
+        # Runs once on the injection thread before the first event
+        return None
+
+class NullInputSink(InputSink):
+    # For view-only and headless servers: input is accepted and dropped
+    name = 'none'
+    
+    def mouse(self, data):
+        pass
+    
+    def key(self, data):
+        pass
+
+class Win32InputSink(InputSink):
+    name = 'win32'
+    
+    def __init__(self):
+        super().__init__()
+        # Imported here so headless and non-Windows servers never load them
+        import win32api
+        import win32con
+        import keyboard
+        self.win32api = win32api
+        self.win32con = win32con
+        self.keyboard = keyboard
+    
+    def mouse(self, data):
+        win32api, win32con = self.win32api, self.win32con
+        event_type = data['type']
+        if event_type == 'wheel':
+            win32api.mouse_event(win32con.MOUSEEVENTF_WHEEL, 0, 0, data['delta'], 0)
+            return
+        
+        x, y = data['x'], data['y']
+        
+        if event_type == 'move':
+            win32api.SetCursorPos((x, y))
+        elif event_type == 'click':
+            button = data.get('button', 'left')
+            state = data.get('state', 'down')
+            
+            if button == 'left':
+                if state == 'down':
+                    win32api.mouse_event(win32con.MOUSEEVENTF_LEFTDOWN, x, y, 0, 0)
+                else:
+                    win32api.mouse_event(win32con.MOUSEEVENTF_LEFTUP, x, y, 0, 0)
+            elif button == 'right':
+                if state == 'down':
+                    win32api.mouse_event(win32con.MOUSEEVENTF_RIGHTDOWN, x, y, 0, 0)
+                else:
+                    win32api.mouse_event(win32con.MOUSEEVENTF_RIGHTUP, x, y, 0, 0)
+    
+    def key(self, data):
+        key = data['key']
+        state = data['state']  # 'down' or 'up'
+        
+        if state == 'down':
+            self.keyboard.press(key)
+        else:
+            self.keyboard.release(key)
+    
+    def raise_priority(self):
+        self.win32api.SetThreadPriority(self.win32api.GetCurrentThread(), self.win32con.THREAD_PRIORITY_HIGHEST)
+    
+    def thread_initializer(self):
+        return self.raise_priority
+
+INPUT_SINKS = {
+    'win32': Win32InputSink,
+    'none': NullInputSink
+}
+
+def available_sinks():
+    # Checked without importing, so listing backends stays cheap
+    sinks = ['none']
+    if sys.platform == 'win32' and importlib.util.find_spec('win32api') and importlib.util.find_spec('keyboard'):
+        sinks.insert(0, 'win32')
+    return sinks
+
+def create_sink(name='auto'):
+    if name == 'auto':
+        name = available_sinks()[0]
+    if name not in INPUT_SINKS:
+        raise ValueError(f"Unknown input backend {name}")
+    return INPUT_SINKS[name]()
@@ -0,0 +1,148 @@
+import asyncio
+import collections
+import os
+import stat
+import threading
+
+PAGE_SIZE = 256  # Entries per listing message
+
+def entry_type(entry, mode):
+    if entry.is_symlink():
+        return 'link'
+    if stat.S_ISDIR(mode):
+        return 'dir'
+    if stat.S_ISREG(mode):
+        return 'file'
+    return 'other'
+
+def scan_page(iterator, limit=PAGE_SIZE):
+    # Pulls the next page off a scandir iterator, so the first entries go out before the scan ends
+    page = []
+    for entry in iterator:
+        try:
+            info = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue  # Removed while we were listing
+        page.append((entry.name, info.st_size, info.st_mtime, entry_type(entry, info.st_mode)))
+        if len(page) >= limit:
+            break
+    return page
+
+def stat_directory(path):
+    directory = os.path.realpath(path or os.path.abspath(os.sep))
+    return directory, os.stat(directory).st_mtime_ns
+
+class DirectoryCache:
+    # Listings keyed by directory and valid while its mtime holds. Files rewritten in place do not
+    # touch the directory mtime, so their size and mtime may lag until something is added or removed.
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.listings = collections.OrderedDict()  # Directory -> (mtime_ns, entries, estimated bytes)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def estimate(entries):
+        # Rough per-entry cost of the tuple, its name and the numbers
+        return sum(len(entry[0]) for entry in entries) + 160 * len(entries)
+    
+    def get(self, directory, mtime_ns):
+        with self.lock:
+            cached = self.listings.get(directory)
+            if cached is None or cached[0] != mtime_ns:
+                self.misses += 1
+                return None
+            self.listings.move_to_end(directory)
+            self.hits += 1
+            return cached[1]
+    
+    def put(self, directory, mtime_ns, entries):
+        size = self.estimate(entries)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.listings.pop(directory, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self.listings[directory] = (mtime_ns, entries, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted) = self.listings.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+    
+    def snapshot(self):
+        with self.lock:
+            return {'directories': len(self.listings), 'bytes': self.bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+class DirectoryBrowser:
+    # Server side of remote browsing for one session; only the newest request is kept running
+    def __init__(self, channel, executor, cache, allowed, filter_listing, page_size=PAGE_SIZE):
+        self.channel = channel
+        self.executor = executor
+        self.cache = cache
+        self.allowed = allowed
+        self.filter_listing = filter_listing  # filter_listing(directory, names) -> restricted flags
+        self.page_size = page_size
+        self.task = None
+    
+    async def io(self, work, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, work, *args)
+    
+    def handle(self, message):
+        self.close()
+        self.task = asyncio.create_task(self.browse(message['id'], message.get('path', '')))
+    
+    async def send_page(self, request_id, directory, page, done):
+        restricted = await self.io(self.filter_listing, directory, [entry[0] for entry in page])
+        entries = [entry for entry, hidden in zip(page, restricted) if not hidden]
+        # Listings are bulk data, frames and input replies go first
+        await self.channel.send({'type': 'listing', 'id': request_id, 'path': directory, 'sep': os.sep,
+                                 'entries': entries, 'done': done}, bulk=True)
+    
+    async def browse(self, request_id, path):
+        try:
+            directory, mtime_ns = await self.io(stat_directory, path)
+            if not self.allowed(directory):
+                raise PermissionError(f"Access to {directory} is restricted")
+            
+            cached = self.cache.get(directory, mtime_ns)
+            if cached is not None:
+                for start in range(0, max(len(cached), 1), self.page_size):
+                    page = cached[start:start + self.page_size]
+                    await self.send_page(request_id, directory, page, start + self.page_size >= len(cached))
+                return
+            
+            entries = []
+            iterator = await self.io(os.scandir, directory)
+            try:
+                while True:
+                    page = await self.io(scan_page, iterator, self.page_size)
+                    entries.extend(page)
+                    done = len(page) < self.page_size
+                    await self.send_page(request_id, directory, page, done)
+                    if done:
+                        break
+            finally:
+                iterator.close()
+            
+            # Only cache what was read if the directory did not change during the scan
+            if (await self.io(stat_directory, directory))[1] == mtime_ns:
+                self.cache.put(directory, mtime_ns, entries)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            try:
+                await self.channel.send({'type': 'listing', 'id': request_id, 'path': path, 'error': str(e), 'done': True})
+            except Exception:
+                pass
+    
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
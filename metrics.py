@@ -0,0 +1,72 @@
+import math
+import threading
+
+class Histogram:
+    # Log-spaced buckets about 9% wide, so recording is one log and a dict increment
+    RESOLUTION = 8  # Buckets per doubling
+    ZERO = -1 << 30  # Bucket for values of zero or less
+    
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.peak = 0.0
+    
+    def add(self, value):
+        bucket = int(math.floor(math.log2(value) * self.RESOLUTION)) if value > 0 else self.ZERO
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.peak = max(self.peak, value)
+    
+    def percentile(self, fraction):
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                if bucket == self.ZERO:
+                    return 0.0
+                # Geometric middle of the bucket, never above the largest value seen
+                return min(2 ** ((bucket + 0.5) / self.RESOLUTION), self.peak)
+        return self.peak
+    
+    def summary(self, scale=1.0, unit=''):
+        return {
+            'count': self.count,
+            f'avg{unit}': self.total / self.count * scale,
+            f'p50{unit}': self.percentile(0.5) * scale,
+            f'p99{unit}': self.percentile(0.99) * scale,
+            f'max{unit}': self.peak * scale,
+            f'total{unit}': self.total * scale
+        }
+
+class StageLatency:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}  # Stage name -> Histogram of seconds
+        self.sizes = {}  # Name -> Histogram of bytes
+    
+    def record(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.add(seconds)
+    
+    def record_bytes(self, name, size):
+        with self.lock:
+            histogram = self.sizes.get(name)
+            if histogram is None:
+                histogram = self.sizes[name] = Histogram()
+            histogram.add(size)
+    
+    def snapshot(self, reset=False):
+        # With reset, each snapshot covers only the time since the previous one
+        with self.lock:
+            stages, sizes = self.stages, self.sizes
+            if reset:
+                self.stages, self.sizes = {}, {}
+            summary = {stage: histogram.summary(1000, '_ms') for stage, histogram in stages.items()}
+            summary.update((name, histogram.summary()) for name, histogram in sizes.items())
+            return summary
@@ -0,0 +1,76 @@
+from PIL import ImageChops
+
+try:
+    import numpy as np
+except ImportError:  # Without NumPy every frame is sent as a plain tile delta
+    np = None
+
+_weights = {}
+
+def line_hashes(array):
+    # One 64-bit fingerprint per row: its bytes as 64-bit words, weighted and summed with wraparound
+    rows = array.reshape(array.shape[0], -1)
+    padding = -rows.shape[1] % 8
+    if padding:
+        rows = np.pad(rows, ((0, 0), (0, padding)))
+    words = np.ascontiguousarray(rows).view(np.uint64)
+    weights = _weights.get(words.shape[1])
+    if weights is None:
+        weights = _weights[words.shape[1]] = np.random.default_rng(words.shape[1]).integers(
+            1, 2 ** 63, size=words.shape[1], dtype=np.uint64) | np.uint64(1)
+    return (words * weights).sum(axis=1, dtype=np.uint64)
+
+def find_shift(before, after, min_run):
+    # Lines of after that equal the lines of before shift further on, as (first line, count, shift)
+    old, new = line_hashes(before), line_hashes(after)
+    # Only lines that occur once in before pin down a position; blank lines match anywhere
+    values, positions, counts = np.unique(old, return_index=True, return_counts=True)
+    values, positions = values[counts == 1], positions[counts == 1]
+    if not len(values):
+        return None
+    found = np.minimum(np.searchsorted(values, new), len(values) - 1)
+    matched = values[found] == new
+    shifts = positions[found[matched]] - np.flatnonzero(matched)
+    shifts = shifts[shifts != 0]
+    if not len(shifts):
+        return None
+    candidates, votes = np.unique(shifts, return_counts=True)
+    shift = int(candidates[votes.argmax()])
+    
+    # The longest run of lines that line up at the winning shift
+    lines = np.arange(max(0, -shift), min(len(new), len(old) - shift))
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], new[lines] == old[lines + shift], [0])).astype(np.int8)))
+    starts, ends = edges[::2], edges[1::2]
+    if not len(starts):
+        return None
+    longest = int((ends - starts).argmax())
+    count = int(ends[longest] - starts[longest])
+    if count < min_run:
+        return None
+    return int(lines[starts[longest]]), count, shift
+
+def detect_moves(previous, image, bbox=None, min_size=128, min_run=64):
+    # Copies, as [x, y, width, height, dx, dy], that turn previous into most of image when a large
+    # region scrolled up, down or sideways; the caller still sends whatever they leave different
+    if np is None or previous.size != image.size:
+        return []
+    if bbox is None:
+        bbox = ImageChops.difference(previous, image).getbbox()
+    if bbox is None:
+        return []
+    left, top, right, bottom = bbox
+    if right - left < min_size or bottom - top < min_size:
+        return []
+    
+    before = np.asarray(previous.crop(bbox))
+    after = np.asarray(image.crop(bbox))
+    # Vertical scrolling is far more common, sideways is only tried when it finds nothing
+    found = find_shift(before, after, min_run)
+    if found is not None:
+        first, count, shift = found
+        return [[left, top + first + shift, right - left, count, 0, -shift]]
+    found = find_shift(before.transpose(1, 0, 2), after.transpose(1, 0, 2), min_run)
+    if found is not None:
+        first, count, shift = found
+        return [[left + first + shift, top, count, bottom - top, -shift, 0]]
+    return []
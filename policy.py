@@ -0,0 +1,99 @@
+import os
+import time
+from pathlib import Path
+
+def path_parts(path):
+    # Case-folded on Windows so C:\Users and c:\users land on the same trie node
+    return Path(os.path.normcase(str(path))).parts
+
+class PathIndex:
+    # Component-wise trie of restricted roots; rebuilt on change and swapped in whole, so readers never lock
+    def __init__(self, roots=()):
+        self.trie = {}
+        for root in roots:
+            node = self.trie
+            for part in path_parts(root):
+                node = node.setdefault(part, {})
+            node[None] = True  # A root ends here, everything below it is covered
+    
+    def lookup(self, parts):
+        # Returns True if a root covers the path, otherwise the trie node reached (None when off the trie)
+        node = self.trie
+        for part in parts:
+            if None in node:
+                return True
+            node = node.get(part)
+            if node is None:
+                return None
+        return True if None in node else node
+    
+    def contains(self, parts):
+        return self.lookup(parts) is True
+
+class RestrictedPaths:
+    def __init__(self):
+        self.restricted_paths = set()
+        self.index = PathIndex()
+        for path in [
+            os.path.expanduser('~'),  # User directory
+            os.path.expandvars('%WINDIR%'),  # Windows directory
+            os.path.expandvars('%PROGRAMFILES%'),  # Program Files
+            os.path.expandvars('%PROGRAMFILES(X86)%')  # Program Files (x86)
+        ]:
+            self.add_restricted_path(path)
+    
+    def is_restricted(self, path):
+        # Only the queried path is resolved, roots were resolved once when added
+        return self.index.contains(path_parts(Path(path).resolve()))
+    
+    def restricted_many(self, paths):
+        index = self.index
+        return [index.contains(path_parts(Path(path).resolve())) for path in paths]
+    
+    def restricted_children(self, directory, names):
+        # Checks a directory listing with one resolve: entries are matched by name below the directory
+        parts = path_parts(Path(directory).resolve())
+        node = self.index.lookup(parts)
+        if node is True:
+            return [True] * len(names)
+        if node is None:
+            return [False] * len(names)  # No root at or below this directory
+        return [None in node.get(os.path.normcase(name), ()) for name in names]
+    
+    def add_restricted_path(self, path):
+        self.restricted_paths.add(str(Path(path).resolve()))
+        self.index = PathIndex(self.restricted_paths)
+    
+    def remove_restricted_path(self, path):
+        self.restricted_paths.discard(str(Path(path).resolve()))
+        self.index = PathIndex(self.restricted_paths)
+
+def benchmark(count=20000, roots=50):
+    restricted = RestrictedPaths()
+    for path in list(restricted.restricted_paths):
+        restricted.remove_restricted_path(path)  # The defaults may cover the working directory
+    base = Path.cwd()
+    for i in range(roots):
+        restricted.add_restricted_path(base / f'restricted{i}')
+    names = [f'entry{i}' for i in range(count)]
+    paths = [str(base / name) for name in names]
+    
+    def legacy(path):
+        path = Path(path).resolve()
+        return any(str(path).startswith(str(Path(rp).resolve())) for rp in restricted.restricted_paths)
+    
+    results = {}
+    for label, check in [
+        ('legacy startswith', lambda: [legacy(path) for path in paths[:count // 10]]),
+        ('indexed', lambda: [restricted.is_restricted(path) for path in paths]),
+        ('batch', lambda: restricted.restricted_many(paths)),
+        ('listing', lambda: restricted.restricted_children(base, names))
+    ]:
+        started = time.perf_counter()
+        checked = len(check())
+        results[label] = checked / (time.perf_counter() - started)
+    return results
+
+if __name__ == "__main__":
+    for label, rate in benchmark().items():
+        print(f"{label}: {rate:,.0f} checks/s")
@@ -0,0 +1,271 @@
+import asyncio
+import json
+import struct
+import threading
+import time
+from framing import FrameReader
+
+PROTOCOL_JSON = 'json'
+PROTOCOL_BINARY = 'binary/1'
+PROTOCOLS = [PROTOCOL_BINARY, PROTOCOL_JSON]  # In order of preference
+
+# Legacy framing: 8 byte big-endian length followed by a JSON document
+LEGACY_HEADER_SIZE = 8
+
+# Binary framing: version, message type, body length
+HEADER = struct.Struct('!BBI')
+VERSION = 1
+
+MSG_CONTROL = 0  # JSON body, for rare control messages
+MSG_MOUSE_MOVE = 1
+MSG_MOUSE_BUTTON = 2
+MSG_MOUSE_WHEEL = 3
+MSG_KEY = 4
+MSG_FRAME = 5  # Header length, JSON header, payload: encoded tiles or a file chunk
+MSG_BATCH = 6  # Input records applied in order, each behind a BATCH_ITEM header
+MSG_TIMED_BATCH = 7  # BATCH_SENT followed by a batch body
+
+MOUSE_MOVE = struct.Struct('!ii')  # x, y
+MOUSE_BUTTON = struct.Struct('!BBii')  # button, state, x, y
+MOUSE_WHEEL = struct.Struct('!i')  # delta
+KEY = struct.Struct('!B')  # state, followed by the UTF-8 keysym
+FRAME_HEADER = struct.Struct('!I')
+BATCH_ITEM = struct.Struct('!BH')  # message type, record length
+BATCH_SENT = struct.Struct('!d')  # When the client sent the batch, in the server's clock
+
+# Messages followed by a binary payload in the legacy framing
+PAYLOAD_TYPES = ('frame', 'file_chunk', 'thumbnail')
+
+BUTTONS = ['left', 'right']
+STATES = ['up', 'down']
+
+class ProtocolError(Exception):
+    pass
+
+def encode_input(message):
+    data = message['data']
+    if message['type'] == 'keyboard':
+        return MSG_KEY, KEY.pack(STATES.index(data['state'])) + data['key'].encode()
+    
+    if data['type'] == 'move':
+        return MSG_MOUSE_MOVE, MOUSE_MOVE.pack(data['x'], data['y'])
+    if data['type'] == 'click':
+        return MSG_MOUSE_BUTTON, MOUSE_BUTTON.pack(BUTTONS.index(data['button']), STATES.index(data['state']), data['x'], data['y'])
+    if data['type'] == 'wheel':
+        return MSG_MOUSE_WHEEL, MOUSE_WHEEL.pack(data['delta'])
+    raise ProtocolError(f"Unknown mouse event {data['type']}")
+
+def decode_input(msg_type, body):
+    if msg_type == MSG_MOUSE_MOVE:
+        x, y = MOUSE_MOVE.unpack(body)
+        return {'type': 'mouse', 'data': {'type': 'move', 'x': x, 'y': y}}
+    if msg_type == MSG_MOUSE_BUTTON:
+        button, state, x, y = MOUSE_BUTTON.unpack(body)
+        return {'type': 'mouse', 'data': {'type': 'click', 'button': BUTTONS[button], 'state': STATES[state], 'x': x, 'y': y}}
+    if msg_type == MSG_MOUSE_WHEEL:
+        delta, = MOUSE_WHEEL.unpack(body)
+        return {'type': 'mouse', 'data': {'type': 'wheel', 'delta': delta}}
+    if msg_type == MSG_KEY:
+        state, = KEY.unpack_from(body)
+        return {'type': 'keyboard', 'data': {'key': bytes(body[KEY.size:]).decode(), 'state': STATES[state]}}
+    raise ProtocolError(f"Unknown message type {msg_type}")
+
+def encode_batch(events):
+    parts = []
+    for event in events:
+        msg_type, body = encode_input(event)
+        parts.append(BATCH_ITEM.pack(msg_type, len(body)))
+        parts.append(body)
+    return b''.join(parts)
+
+def decode_batch(body):
+    events = []
+    offset = 0
+    while offset < len(body):
+        msg_type, length = BATCH_ITEM.unpack_from(body, offset)
+        offset += BATCH_ITEM.size
+        events.append(decode_input(msg_type, body[offset:offset + length]))
+        offset += length
+    return {'type': 'batch', 'events': events}
+
+def pack_message(protocol, message, payload=None):
+    if protocol == PROTOCOL_JSON:
+        data = json.dumps(message).encode()
+        parts = [len(data).to_bytes(LEGACY_HEADER_SIZE, byteorder='big'), data]
+        if payload is not None:
+            parts.append(len(payload).to_bytes(LEGACY_HEADER_SIZE, byteorder='big'))
+        return b''.join(parts)
+    
+    if message['type'] in ('mouse', 'keyboard'):
+        msg_type, body = encode_input(message)
+        return HEADER.pack(VERSION, msg_type, len(body)) + body
+    if message['type'] == 'batch':
+        body = encode_batch(message['events'])
+        if 'sent' in message:
+            body = BATCH_SENT.pack(message['sent']) + body
+            return HEADER.pack(VERSION, MSG_TIMED_BATCH, len(body)) + body
+        return HEADER.pack(VERSION, MSG_BATCH, len(body)) + body
+    
+    data = json.dumps(message).encode()
+    if payload is None:
+        return HEADER.pack(VERSION, MSG_CONTROL, len(data)) + data
+    length = FRAME_HEADER.size + len(data) + len(payload)
+    return HEADER.pack(VERSION, MSG_FRAME, length) + FRAME_HEADER.pack(len(data)) + data
+
+def parse_body(msg_type, body):
+    # Returns the message and, for frames, a view of the encoded tiles inside body
+    if msg_type == MSG_FRAME:
+        header_size, = FRAME_HEADER.unpack_from(body)
+        end = FRAME_HEADER.size + header_size
+        return json.loads(bytes(body[FRAME_HEADER.size:end])), memoryview(body)[end:]
+    if msg_type == MSG_CONTROL:
+        return json.loads(bytes(body)), None
+    if msg_type == MSG_BATCH:
+        return decode_batch(body), None
+    if msg_type == MSG_TIMED_BATCH:
+        message = decode_batch(memoryview(body)[BATCH_SENT.size:])
+        message['sent'], = BATCH_SENT.unpack_from(body)
+        return message, None
+    return decode_input(msg_type, body), None
+
+class Channel:
+    def __init__(self, sock, pool=None):
+        self.sock = sock
+        self.reader = FrameReader(sock, pool)
+        self.header = bytearray(max(HEADER.size, LEGACY_HEADER_SIZE))
+        self.protocol = PROTOCOL_JSON  # Until the hello exchange selects something else
+        self.send_lock = threading.Lock()
+        self.header_at = None  # When the last message started arriving, so waiting for it is not counted
+    
+    def pack(self, message, payload=None):
+        return pack_message(self.protocol, message, payload)
+    
+    def send(self, message, payload=None):
+        # Header and body go out in one write so small events fit in one TLS record
+        with self.send_lock:
+            self.sock.sendall(self.pack(message, payload))
+            if payload is not None:
+                self.sock.sendall(payload)
+    
+    def negotiate(self, protocol):
+        # Switch right after the hello so no message is framed for the wrong protocol
+        with self.send_lock:
+            self.sock.sendall(self.pack({'type': 'hello', 'protocol': protocol}))
+            self.protocol = protocol
+    
+    def recv(self):
+        # A returned payload is a view into a pooled buffer, pass it to release() when done
+        if self.protocol == PROTOCOL_JSON:
+            return self.recv_json()
+        return self.recv_binary()
+    
+    def release(self, payload):
+        self.reader.release(payload)
+    
+    def read_header(self, size):
+        view = memoryview(self.header)[:size]
+        if not self.reader.read_into(view):
+            return None
+        return view
+    
+    def recv_json(self):
+        size_data = self.read_header(LEGACY_HEADER_SIZE)
+        if size_data is None:
+            return None, None
+        
+        self.header_at = time.perf_counter()
+        data = self.reader.read(int.from_bytes(size_data, byteorder='big'))
+        if data is None:
+            return None, None
+        
+        message = json.loads(bytes(data))
+        self.reader.release(data)
+        if message.get('type') not in PAYLOAD_TYPES:
+            return message, None
+        
+        size_data = self.read_header(LEGACY_HEADER_SIZE)
+        if size_data is None:
+            return None, None
+        return message, self.reader.read(int.from_bytes(size_data, byteorder='big'))
+    
+    def recv_binary(self):
+        header = self.read_header(HEADER.size)
+        if header is None:
+            return None, None
+        
+        self.header_at = time.perf_counter()
+        version, msg_type, length = HEADER.unpack(header)
+        if version != VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        
+        body = self.reader.read(length)
+        if body is None:
+            return None, None
+        
+        if msg_type == MSG_FRAME:
+            # Only the frame header is copied out, the tiles stay in the pooled buffer
+            return parse_body(msg_type, body)
+        
+        try:
+            return parse_body(msg_type, body)
+        finally:
+            self.reader.release(body)
+
+class AsyncChannel:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.protocol = PROTOCOL_JSON  # Until the hello exchange selects something else
+        self.send_lock = asyncio.Lock()
+        self.urgent = 0  # Frames and control messages waiting for or holding the lock
+        self.idle = asyncio.Event()
+        self.idle.set()
+    
+    async def send(self, message, payload=None, bulk=False):
+        if bulk:
+            # Bulk data such as file chunks only goes out when nothing else is waiting
+            while self.urgent:
+                await self.idle.wait()
+        else:
+            self.urgent += 1
+            self.idle.clear()
+        try:
+            # Messages are framed when written, so a protocol switch applies in stream order
+            async with self.send_lock:
+                if self.writer.is_closing():
+                    raise ConnectionResetError("Connection is closed")
+                self.writer.write(pack_message(self.protocol, message, payload))
+                if payload is not None:
+                    self.writer.write(payload)
+                await self.writer.drain()
+        finally:
+            if not bulk:
+                self.urgent -= 1
+                if not self.urgent:
+                    self.idle.set()
+    
+    def set_protocol(self, protocol):
+        self.protocol = protocol
+    
+    async def recv(self):
+        try:
+            if self.protocol == PROTOCOL_JSON:
+                return await self.recv_json()
+            return await self.recv_binary()
+        except asyncio.IncompleteReadError:
+            return None, None
+    
+    async def recv_json(self):
+        size_data = await self.reader.readexactly(LEGACY_HEADER_SIZE)
+        message = json.loads(await self.reader.readexactly(int.from_bytes(size_data, byteorder='big')))
+        if message.get('type') not in PAYLOAD_TYPES:
+            return message, None
+        
+        size_data = await self.reader.readexactly(LEGACY_HEADER_SIZE)
+        return message, await self.reader.readexactly(int.from_bytes(size_data, byteorder='big'))
+    
+    async def recv_binary(self):
+        version, msg_type, length = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+        if version != VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        return parse_body(msg_type, await self.reader.readexactly(length))
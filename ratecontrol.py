@@ -0,0 +1,178 @@
+import collections
+import math
+
+class RateController:
+    # Closed loop over acknowledged frames for one viewer. It keeps latency inside the budget by
+    # giving up frame rate first, then quality, then resolution, and wins them back in reverse order.
+    FLOOR_FPS = 10  # Frame rate given up before touching quality or resolution
+    MIN_FPS = 2
+    MIN_QUALITY = 30
+    MIN_SCALE = 0.5
+    QUALITY_STEP = 10
+    SCALE_STEP = 0.75
+    SETTLE = 2.0  # Seconds between quality or scale changes, each one costs the viewer a keyframe
+    DECIDE_INTERVAL = 0.5
+    RECOVERY = 4  # Healthy decisions in a row before ramping up
+    MAX_INFLIGHT = 8
+    
+    def __init__(self, budget=0.15, window=1.0):
+        self.budget = budget
+        self.window = window  # Seconds of acks the delivery rate is measured over
+        self.max_fps = None
+        self.max_quality = None
+        self.fps = None
+        self.quality = None
+        self.scale = 1.0
+        self.inflight = collections.OrderedDict()  # Frame id -> (sent at, bytes)
+        self.inflight_bytes = 0
+        self.acked = collections.deque()  # (acked at, bytes)
+        self.rtts = collections.deque()  # (acked at, round trip), for the windowed minimum
+        self.srtt = None
+        self.min_rtt = None
+        self.decided_at = 0.0
+        self.changed_at = 0.0
+        self.healthy = 0
+        self.reason = 'starting'
+    
+    def limit(self, max_fps, max_quality):
+        # The manual settings are ceilings; a raised ceiling is ramped up to, not jumped to
+        if self.fps is None:
+            self.fps, self.quality = max_fps, max_quality
+        self.max_fps, self.max_quality = max_fps, max_quality
+        self.fps = min(self.fps, max_fps)
+        self.quality = min(self.quality, max_quality)
+        return self.fps, self.quality, self.scale
+    
+    def reset(self):
+        # Frames in flight on a dropped connection are never acknowledged; the estimates carry over
+        self.inflight.clear()
+        self.inflight_bytes = 0
+    
+    def on_send(self, frame_id, size, now):
+        self.inflight[frame_id] = (now, size)
+        self.inflight_bytes += size
+    
+    def on_ack(self, frame_id, now):
+        # Acks are cumulative, the client may coalesce them
+        sample = None
+        while self.inflight:
+            oldest = next(iter(self.inflight))
+            if oldest > frame_id:
+                break
+            sent_at, size = self.inflight.pop(oldest)
+            self.inflight_bytes -= size
+            self.acked.append((now, size))
+            sample = now - sent_at
+        if sample is None:
+            return
+        
+        self.srtt = sample if self.srtt is None else self.srtt * 0.875 + sample * 0.125
+        self.rtts.append((now, sample))
+        while self.rtts[0][0] < now - 10 * self.window:
+            self.rtts.popleft()
+        self.min_rtt = min(rtt for _, rtt in self.rtts)
+    
+    def delivery_rate(self, now):
+        while self.acked and self.acked[0][0] < now - self.window:
+            self.acked.popleft()
+        return sum(size for _, size in self.acked) / self.window
+    
+    def queue_delay(self):
+        return self.srtt - self.min_rtt if self.srtt is not None else 0.0
+    
+    def may_send(self, now):
+        # Frames beyond what the link delivers within the budget would only queue, skip them instead
+        if not self.inflight:
+            return True
+        if len(self.inflight) >= self.MAX_INFLIGHT:
+            return False
+        rate = self.delivery_rate(now)
+        if not rate:
+            return len(self.inflight) < 2
+        return self.inflight_bytes < rate * self.budget
+    
+    def oldest_age(self, now):
+        if not self.inflight:
+            return 0.0
+        return now - next(iter(self.inflight.values()))[0]
+    
+    def update(self, now):
+        # Returns True when fps, quality or scale changed
+        if self.srtt is None or now - self.decided_at < self.DECIDE_INTERVAL:
+            return False
+        self.decided_at = now
+        
+        latency = max(self.srtt, self.oldest_age(now))
+        queued = self.queue_delay()
+        if latency > self.budget or queued > self.budget / 2:
+            self.healthy = 0
+            return self.back_off(now)
+        if latency < self.budget / 2 and queued < self.budget / 4:
+            self.healthy += 1
+            if self.healthy >= self.RECOVERY:
+                return self.ramp_up(now)
+            return False
+        self.healthy = 0
+        self.reason = 'holding'
+        return False
+    
+    def settled(self, now):
+        return now - self.changed_at >= self.SETTLE
+    
+    def back_off(self, now):
+        if self.fps > min(self.FLOOR_FPS, self.max_fps):
+            self.fps = max(min(self.FLOOR_FPS, self.max_fps), math.floor(self.fps * 0.7))
+            self.reason = 'latency high, lower fps'
+        elif (self.quality > self.MIN_QUALITY or self.scale > self.MIN_SCALE) and not self.settled(now):
+            # Holding back frames already keeps the queue bounded while the last change takes effect
+            self.reason = 'latency high, settling'
+            return False
+        elif self.quality > self.MIN_QUALITY:
+            self.quality = max(self.MIN_QUALITY, self.quality - self.QUALITY_STEP)
+            self.changed_at = now
+            self.reason = 'latency high, lower quality'
+        elif self.scale > self.MIN_SCALE:
+            self.scale = max(self.MIN_SCALE, round(self.scale * self.SCALE_STEP, 3))
+            self.changed_at = now
+            self.reason = 'latency high, lower resolution'
+        elif self.fps > self.MIN_FPS:
+            self.fps = max(self.MIN_FPS, math.floor(self.fps * 0.7))
+            self.reason = 'latency high, lower fps'
+        else:
+            self.reason = 'latency high, at minimum'
+            return False
+        return True
+    
+    def ramp_up(self, now):
+        if self.fps < min(self.FLOOR_FPS, self.max_fps):
+            self.fps = min(self.FLOOR_FPS, self.max_fps, self.fps + 2)
+            self.reason = 'link recovered, raise fps'
+        elif self.scale < 1.0:
+            if not self.settled(now):
+                return False
+            self.scale = min(1.0, round(self.scale / self.SCALE_STEP, 3))
+            self.changed_at = now
+            self.reason = 'link recovered, raise resolution'
+        elif self.quality < self.max_quality:
+            if not self.settled(now):
+                return False
+            self.quality = min(self.max_quality, self.quality + self.QUALITY_STEP)
+            self.changed_at = now
+            self.reason = 'link recovered, raise quality'
+        elif self.fps < self.max_fps:
+            self.fps = min(self.max_fps, self.fps + max(1, math.floor(self.fps * 0.25)))
+            self.reason = 'link recovered, raise fps'
+        else:
+            self.reason = 'at ceiling'
+            return False
+        return True
+    
+    def state(self, now):
+        return {
+            'fps': self.fps,
+            'quality': self.quality,
+            'scale': self.scale,
+            'rtt_ms': (self.srtt or 0.0) * 1000,
+            'kbps': self.delivery_rate(now) * 8 / 1000,
+            'reason': self.reason
+        }
@@ -1,75 +1,51 @@
-import socket
-import ssl
-import threading
-import pyautogui
-import keyboard
-import win32gui
-import win32con
-import win32api
-import os
-from PIL import ImageGrab
-import io
-import json
-from pathlib import Path
 import tkinter as tk
-from tkinter import messagebox, filedialog
-import subprocess
-import requests
-
-class RestrictedPaths:
-    def __init__(self):
-        self.restricted_paths = set([
-            os.path.expanduser('~'),  # User directory
-            os.path.expandvars('%WINDIR%'),  # Windows directory
-            os.path.expandvars('%PROGRAMFILES%'),  # Program Files
-            os.path.expandvars('%PROGRAMFILES(X86)%')  # Program Files (x86)
-        ])
-    
-    def is_restricted(self, path):
-        path = Path(path).resolve()
-        return any(str(path).startswith(str(Path(rp).resolve())) for rp in self.restricted_paths)
-    
-    def add_restricted_path(self, path):
-        self.restricted_paths.add(str(Path(path).resolve()))
-    
-    def remove_restricted_path(self, path):
-        self.restricted_paths.discard(str(Path(path).resolve()))
+from tkinter import filedialog
+from engine import AsyncEngine
+from capture import create_source
+from inputs import create_sink
+from policy import RestrictedPaths
+from tunnel import NgrokTunnel
+from service import server_context
 
 class SecureServer:
-    def __init__(self, host='0.0.0.0', port=4443):
+    def __init__(self, host='0.0.0.0', port=4443, backlog=128, capture_backend='auto', encode_workers=None,
+                 encode_mode='thread', input_backend='auto'):
         self.host = host
         self.port = port
-        self.screen_width, self.screen_height = pyautogui.size()
+        self.backlog = backlog
+        self.capture_source = create_source(capture_backend)
+        self.encode_workers = encode_workers
+        self.encode_mode = encode_mode
         self.restricted_paths = RestrictedPaths()
         
-        # Disable PyAutoGUI fail-safe
-        pyautogui.FAILSAFE = False
+        # Platform input modules are imported when the sink is built, only for the backend chosen
+        self.input_sink = create_sink(input_backend)
         
         # SSL setup
         self.setup_ssl()
         
-        # Create socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((self.host, self.port))
-        self.sock.listen(1)
-        
         # Control flags
         self.running = False
-        self.allow_input = True
         
-        # Ngrok process
-        self.ngrok_process = None
+        # Ngrok tunnel, discovered in the background while local clients can already connect
+        self.tunnel = None
         self.ngrok_url = None
         
         # GUI setup
         self.setup_gui()
+        
+        # Sessions are served by an asyncio engine, blocking work runs in its executors
+        self.engine = AsyncEngine(self.context, self.capture_source, self.input_sink.inject,
+                                  self.handle_file_access, self.host, self.port,
+                                  backlog=self.backlog, encode_workers=self.encode_workers,
+                                  encode_mode=self.encode_mode,
+                                  filter_listing=self.restricted_paths.restricted_children,
+                                  input_initializer=self.input_sink.thread_initializer(),
+                                  # Status changes come from the engine's thread, the label is updated from the Tk thread
+                                  on_status=lambda text: self.root.after(0, self.status_label.config, {'text': text}))
     
     def setup_ssl(self):
-        self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        self.context.load_cert_chain(certfile='server.crt', keyfile='server.key')
-        self.context.verify_mode = ssl.CERT_REQUIRED
-        self.context.load_verify_locations(cafile='rootCA.crt')
+        self.context = server_context()
     
     def setup_gui(self):
         self.root = tk.Tk()
@@ -141,118 +117,31 @@ class SecureServer:
             self.update_paths_list()
     
     def toggle_input(self):
-        self.allow_input = self.input_var.get()
-    
-    def handle_mouse_event(self, event_data):
-        if not self.allow_input:
-            return
-        
-        event_type = event_data['type']
-        x, y = event_data['x'], event_data['y']
-        
-        if event_type == 'move':
-            win32api.SetCursorPos((x, y))
-        elif event_type == 'click':
-            button = event_data.get('button', 'left')
-            state = event_data.get('state', 'down')
-            
-            if button == 'left':
-                if state == 'down':
-                    win32api.mouse_event(win32con.MOUSEEVENTF_LEFTDOWN, x, y, 0, 0)
-                else:
-                    win32api.mouse_event(win32con.MOUSEEVENTF_LEFTUP, x, y, 0, 0)
-            elif button == 'right':
-                if state == 'down':
-                    win32api.mouse_event(win32con.MOUSEEVENTF_RIGHTDOWN, x, y, 0, 0)
-                else:
-                    win32api.mouse_event(win32con.MOUSEEVENTF_RIGHTUP, x, y, 0, 0)
-    
-    def handle_keyboard_event(self, event_data):
-        if not self.allow_input:
-            return
-        
-        key = event_data['key']
-        state = event_data['state']  # 'down' or 'up'
-        
-        if state == 'down':
-            keyboard.press(key)
-        else:
-            keyboard.release(key)
+        self.input_sink.enabled = self.input_var.get()
     
     def handle_file_access(self, path):
         return not self.restricted_paths.is_restricted(path)
     
-    def handle_client(self, conn, addr):
+    def start_ngrok(self):
+        self.ngrok_label.config(text="Ngrok: Starting...")
+        # Callbacks arrive on the polling thread, the labels are updated from the Tk thread
+        self.tunnel = NgrokTunnel(self.port,
+                                  on_url=lambda url: self.root.after(0, self.on_ngrok_url, url),
+                                  on_error=lambda text: self.root.after(0, self.ngrok_label.config, {'text': f"Ngrok: {text}"}))
         try:
-            self.status_label.config(text=f"Connected to {addr}")
-            
-            while True:
-                # Receive message size first
-                size_data = conn.recv(8)
-                if not size_data:
-                    break
-                
-                msg_size = int.from_bytes(size_data, byteorder='big')
-                
-                # Receive full message
-                data = b''
-                while len(data) < msg_size:
-                    chunk = conn.recv(min(msg_size - len(data), 4096))
-                    if not chunk:
-                        break
-                    data += chunk
-                
-                if not data:
-                    break
-                
-                message = json.loads(data.decode())
-                
-                if message['type'] == 'mouse':
-                    self.handle_mouse_event(message['data'])
-                elif message['type'] == 'keyboard':
-                    self.handle_keyboard_event(message['data'])
-                elif message['type'] == 'screenshot':
-                    # Take screenshot and send
-                    screenshot = ImageGrab.grab()
-                    img_bytes = io.BytesIO()
-                    screenshot.save(img_bytes, format='PNG')
-                    size = len(img_bytes.getvalue())
-                    conn.send(size.to_bytes(8, byteorder='big'))
-                    conn.sendall(img_bytes.getvalue())
-                elif message['type'] == 'file_access':
-                    # Check if file access is allowed
-                    allowed = self.handle_file_access(message['data']['path'])
-                    response = json.dumps({'allowed': allowed}).encode()
-                    size = len(response)
-                    conn.send(size.to_bytes(8, byteorder='big'))
-                    conn.sendall(response)
-                
-        except Exception as e:
-            print(f"Error handling client: {e}")
-        finally:
-            conn.close()
-            self.status_label.config(text="Waiting for connection")
+            self.tunnel.start()
+        except OSError as e:
+            self.ngrok_label.config(text=f"Ngrok: {e}")
+            self.tunnel = None
     
-    def start_ngrok(self):
-        ngrok_command = f"ngrok tcp {self.port}"
-        self.ngrok_process = subprocess.Popen(ngrok_command.split(), stdout=subprocess.PIPE)
-        
-        # Wait for ngrok to generate the public URL
-        while True:
-            try:
-                ngrok_tunnels = requests.get("http://localhost:4040/api/tunnels").json()["tunnels"]
-                for tunnel in ngrok_tunnels:
-                    if tunnel["proto"] == "tcp":
-                        self.ngrok_url = tunnel["public_url"]
-                        self.ngrok_label.config(text=f"Ngrok URL: {self.ngrok_url}")
-                        return
-            except:
-                pass
+    def on_ngrok_url(self, url):
+        self.ngrok_url = url
+        self.ngrok_label.config(text=f"Ngrok URL: {self.ngrok_url}")
     
     def stop_ngrok(self):
-        if self.ngrok_process:
-            self.ngrok_process.terminate()
-            self.ngrok_process = None
+        if self.tunnel:
+            self.tunnel.stop()
+            self.tunnel = None
         self.ngrok_url = None
         self.ngrok_label.config(text="Ngrok: Not running")
     
@@ -262,28 +151,13 @@ class SecureServer:
         self.start_button.config(state=tk.DISABLED)
         self.stop_button.config(state=tk.NORMAL)
         
-        # Start ngrok
+        # Accept local connections first, the tunnel comes up alongside
+        self.engine.start()
         self.start_ngrok()
-        
-        def server_loop():
-            self.status_label.config(text="Waiting for connection")
-            while self.running:
-                try:
-                    client_sock, addr = self.sock.accept()
-                    ssl_conn = self.context.wrap_socket(client_sock, server_side=True)
-                    client_thread = threading.Thread(target=self.handle_client, 
-                                                  args=(ssl_conn, addr))
-                    client_thread.start()
-                except Exception as e:
-                    if self.running:
-                        print(f"Error accepting connection: {e}")
-        
-        self.server_thread = threading.Thread(target=server_loop)
-        self.server_thread.start()
     
     def stop_server(self):
         self.running = False
-        self.sock.close()
+        self.engine.stop()
         self.stop_ngrok()
         self.status_label.config(text="Stopped")
         self.start_button.config(state=tk.NORMAL)
@@ -293,5 +167,13 @@ class SecureServer:
         self.root.mainloop()
 
 if __name__ == "__main__":
-    server = SecureServer()
+    import argparse
+    parser = argparse.ArgumentParser(description="Remote control server; see service.py to run without a GUI")
+    parser.add_argument('--port', type=int, default=4443)
+    parser.add_argument('--start', action='store_true', help="Start serving right away")
+    args = parser.parse_args()
+    
+    server = SecureServer(port=args.port)
+    if args.start:
+        server.start_server()
     server.run()
\ No newline at end of file
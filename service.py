@@ -0,0 +1,127 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import ssl
+from datetime import datetime
+from engine import AsyncEngine
+from capture import create_source, available_sources
+from inputs import create_sink, available_sinks
+from policy import RestrictedPaths
+from tunnel import NgrokTunnel
+
+# Headless server for running as a background service; nothing here imports Tk
+
+DEFAULTS = {
+    'host': '0.0.0.0',
+    'port': 4443,
+    'certs': '.',  # Directory holding server.crt, server.key and rootCA.crt
+    'restricted_paths': [],  # Added to the built-in restrictions
+    'allow_input': True,
+    'tunnel': False,
+    'capture': 'auto',
+    'input': 'auto',
+    'encode_workers': None,
+    'encode_mode': 'thread',
+    'backlog': 128
+}
+
+def server_context(certs='.'):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile=os.path.join(certs, 'server.crt'), keyfile=os.path.join(certs, 'server.key'))
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(cafile=os.path.join(certs, 'rootCA.crt'))
+    # Reconnecting clients resume with a session ticket instead of a full mutual-TLS handshake
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = 2
+    return context
+
+def load_config(path=None, overrides=None):
+    # Defaults, then the JSON config file, then whatever was given on the command line
+    config = dict(DEFAULTS)
+    if path:
+        with open(path) as f:
+            loaded = json.load(f)
+        unknown = set(loaded) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown config keys: {', '.join(sorted(unknown))}")
+        config.update(loaded)
+    config.update((key, value) for key, value in (overrides or {}).items() if value is not None)
+    return config
+
+class HeadlessServer:
+    def __init__(self, config):
+        self.config = config
+        self.context = server_context(config['certs'])
+        self.restricted_paths = RestrictedPaths()
+        for path in config['restricted_paths']:
+            self.restricted_paths.add_restricted_path(path)
+        self.input_sink = create_sink(config['input'] if config['allow_input'] else 'none')
+        self.capture_source = create_source(config['capture'])
+        self.tunnel = None
+        self.engine = AsyncEngine(self.context, self.capture_source, self.input_sink.inject,
+                                  self.handle_file_access, config['host'], config['port'],
+                                  backlog=config['backlog'], encode_workers=config['encode_workers'],
+                                  encode_mode=config['encode_mode'],
+                                  filter_listing=self.restricted_paths.restricted_children,
+                                  input_initializer=self.input_sink.thread_initializer(),
+                                  on_status=self.log)
+    
+    def log(self, text):
+        print(f"{datetime.now().strftime('%H:%M:%S')}: {text}", flush=True)
+    
+    def handle_file_access(self, path):
+        return not self.restricted_paths.is_restricted(path)
+    
+    def stop(self):
+        self.engine.stop()
+    
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: Ctrl+C still interrupts asyncio.run
+        
+        serving = asyncio.create_task(self.engine.serve())
+        await loop.run_in_executor(None, self.engine.ready.wait)
+        if not serving.done():
+            self.log(f"Listening on {self.config['host']}:{self.engine.port}, "
+                     f"capture {self.capture_source.name}, input {self.input_sink.name}")
+            if self.config['tunnel']:
+                self.tunnel = NgrokTunnel(self.engine.port, on_url=lambda url: self.log(f"Ngrok URL: {url}"),
+                                          on_error=lambda text: self.log(f"Ngrok: {text}"))
+                self.tunnel.start()
+        try:
+            await serving
+        finally:
+            if self.tunnel:
+                self.tunnel.stop()
+    
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the remote control server without a GUI")
+    parser.add_argument('--config', help="JSON file with any of: " + ", ".join(DEFAULTS))
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--certs', help="Directory with server.crt, server.key and rootCA.crt")
+    parser.add_argument('--restrict', action='append', default=[], help="Extra restricted path, repeatable")
+    parser.add_argument('--input', dest='allow_input', action=argparse.BooleanOptionalAction, help="Allow remote input")
+    parser.add_argument('--tunnel', action=argparse.BooleanOptionalAction, help="Start an ngrok tunnel")
+    parser.add_argument('--capture-backend', dest='capture', choices=['auto'] + available_sources())
+    parser.add_argument('--input-backend', dest='input', choices=['auto'] + available_sinks())
+    parser.add_argument('--encode-workers', type=int)
+    parser.add_argument('--encode-mode', choices=['thread', 'process'])
+    args = vars(parser.parse_args())
+    
+    restrict = args.pop('restrict')
+    config = load_config(args.pop('config'), args)
+    config['restricted_paths'] = list(config['restricted_paths']) + restrict
+    HeadlessServer(config).run()
@@ -0,0 +1,367 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import queue
+import threading
+
+CHUNK_SIZE = 64 * 1024
+WINDOW = 8  # Unacknowledged chunks allowed in flight per transfer
+
+# Messages that belong to the file channel rather than the session
+TRANSFER_MESSAGES = ('download', 'upload', 'file_info', 'file_chunk', 'file_ack', 'file_done', 'file_error', 'transfer_cancel')
+
+def chunk_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+class PartialFile:
+    # A .part file that only ever holds verified chunks, with a sidecar naming the source it came from
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.part_path = path + '.part'
+        self.state_path = path + '.part.json'
+        self.fingerprint = fingerprint
+        self.file = None
+    
+    def open(self):
+        # Returns the offset to resume from, zero unless the partial data is from the same source
+        offset = 0
+        try:
+            with open(self.state_path) as f:
+                if json.load(f) == self.fingerprint:
+                    offset = os.path.getsize(self.part_path)
+        except (OSError, ValueError):
+            pass
+        if offset != self.fingerprint['size']:
+            offset -= offset % CHUNK_SIZE  # A chunk cut short by a crash is sent again
+        
+        self.file = open(self.part_path, 'r+b' if offset else 'wb')
+        self.file.truncate(offset)
+        with open(self.state_path, 'w') as f:
+            json.dump(self.fingerprint, f)
+        return offset
+    
+    def write(self, offset, data):
+        self.file.seek(offset)
+        self.file.write(data)
+    
+    def finish(self):
+        self.file.close()
+        os.replace(self.part_path, self.path)
+        os.remove(self.state_path)
+    
+    def close(self):
+        # Keeps the partial data so the transfer can resume later
+        if self.file is not None:
+            self.file.close()
+
+class ChunkReceiver:
+    def __init__(self, transfer_id, partial):
+        self.transfer_id = transfer_id
+        self.partial = partial
+        self.size = partial.fingerprint['size']
+        self.offset = 0  # Everything before this has been verified and written
+    
+    @classmethod
+    def open(cls, transfer_id, path, fingerprint):
+        receiver = cls(transfer_id, PartialFile(path, fingerprint))
+        receiver.offset = receiver.partial.open()
+        return receiver
+    
+    @property
+    def complete(self):
+        return self.offset >= self.size
+    
+    def ack(self, retry=False):
+        return {'type': 'file_ack', 'id': self.transfer_id, 'offset': self.offset, 'retry': retry}
+    
+    def receive(self, message, payload):
+        # Returns the ack to send back, or None for a chunk sent before the last retry
+        if message['offset'] != self.offset:
+            return None
+        if len(payload) > CHUNK_SIZE or chunk_digest(payload) != message['sha256']:
+            return self.ack(retry=True)
+        self.partial.write(self.offset, payload)
+        self.offset += len(payload)
+        return self.ack()
+    
+    def finish(self):
+        self.partial.finish()
+    
+    def close(self):
+        self.partial.close()
+
+class ChunkSender:
+    def __init__(self, transfer_id, file, size, window=WINDOW):
+        self.transfer_id = transfer_id
+        self.file = file
+        self.size = size
+        self.window = window
+        self.position = None  # Next offset to send, unknown until the receiver says where to resume
+        self.acked = 0
+    
+    @classmethod
+    def open(cls, transfer_id, path, window=WINDOW):
+        file = open(path, 'rb')
+        return cls(transfer_id, file, os.fstat(file.fileno()).st_size, window)
+    
+    def fingerprint(self):
+        stat = os.fstat(self.file.fileno())
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+    
+    @property
+    def complete(self):
+        return self.acked >= self.size
+    
+    def ack(self, message):
+        self.acked = message['offset']
+        if self.position is None or message.get('retry'):
+            self.position = self.acked
+    
+    def ready(self):
+        return (self.position is not None and self.position < self.size and
+                self.position < self.acked + self.window * CHUNK_SIZE)
+    
+    def next_chunk(self):
+        # Chunks are read one at a time, the file is never held in memory
+        self.file.seek(self.position)
+        data = self.file.read(CHUNK_SIZE)
+        message = {'type': 'file_chunk', 'id': self.transfer_id, 'offset': self.position, 'sha256': chunk_digest(data)}
+        self.position += len(data)
+        return message, data
+    
+    def close(self):
+        self.file.close()
+
+class TransferManager:
+    # Server side of the file channel for one session; disk I/O runs in an executor
+    def __init__(self, channel, executor, allowed, window=WINDOW):
+        self.channel = channel
+        self.executor = executor
+        self.allowed = allowed
+        self.window = window
+        self.senders = {}  # Download id -> (ChunkSender, wakeup event)
+        self.inboxes = {}  # Upload id -> queue of received chunks
+        self.tasks = {}
+    
+    async def io(self, work, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, work, *args)
+    
+    def handle(self, message, payload):
+        # Called from the session's receive loop, so it only dispatches
+        transfer_id = message['id']
+        if message['type'] == 'download':
+            self.start(transfer_id, self.download(transfer_id, message['path']))
+        elif message['type'] == 'upload':
+            self.inboxes[transfer_id] = asyncio.Queue()
+            self.start(transfer_id, self.upload(transfer_id, message))
+        elif message['type'] == 'file_ack' and transfer_id in self.senders:
+            sender, wakeup = self.senders[transfer_id]
+            sender.ack(message)
+            wakeup.set()
+        elif message['type'] == 'file_chunk' and transfer_id in self.inboxes:
+            self.inboxes[transfer_id].put_nowait((message, payload))
+        elif message['type'] == 'transfer_cancel' and transfer_id in self.tasks:
+            self.tasks[transfer_id].cancel()
+    
+    def start(self, transfer_id, transfer):
+        if transfer_id in self.tasks:
+            self.tasks[transfer_id].cancel()
+        self.tasks[transfer_id] = asyncio.create_task(self.run(transfer_id, transfer))
+    
+    async def run(self, transfer_id, transfer):
+        try:
+            await transfer
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error transferring file: {e}")
+            try:
+                await self.channel.send({'type': 'file_error', 'id': transfer_id, 'error': str(e)})
+            except Exception:
+                pass
+        finally:
+            if self.tasks.get(transfer_id) is asyncio.current_task():
+                del self.tasks[transfer_id]
+    
+    def check(self, path):
+        if not self.allowed(path):
+            raise PermissionError(f"Access to {path} is restricted")
+    
+    async def download(self, transfer_id, path):
+        self.check(path)
+        sender = await self.io(ChunkSender.open, transfer_id, path, self.window)
+        wakeup = asyncio.Event()
+        entry = self.senders[transfer_id] = (sender, wakeup)
+        try:
+            fingerprint = await self.io(sender.fingerprint)
+            await self.channel.send(dict(fingerprint, type='file_info', id=transfer_id, chunk_size=CHUNK_SIZE))
+            
+            # The receiver's first ack says where to resume, later ones open up the window
+            while not sender.complete:
+                if not sender.ready():
+                    wakeup.clear()
+                    await wakeup.wait()
+                    continue
+                message, data = await self.io(sender.next_chunk)
+                await self.channel.send(message, data, bulk=True)
+        finally:
+            # A restarted transfer with the same id may already have replaced this entry
+            if self.senders.get(transfer_id) is entry:
+                del self.senders[transfer_id]
+            await self.io(sender.close)
+    
+    async def upload(self, transfer_id, message):
+        inbox = self.inboxes[transfer_id]
+        receiver = None
+        try:
+            self.check(message['path'])
+            fingerprint = {'size': message['size'], 'mtime': message['mtime']}
+            receiver = await self.io(ChunkReceiver.open, transfer_id, message['path'], fingerprint)
+            await self.channel.send(receiver.ack())
+            
+            while not receiver.complete:
+                chunk, payload = await inbox.get()
+                ack = await self.io(receiver.receive, chunk, payload)
+                if ack is not None:
+                    await self.channel.send(ack)
+            
+            await self.io(receiver.finish)
+            receiver = None
+            await self.channel.send({'type': 'file_done', 'id': transfer_id, 'size': message['size']})
+        finally:
+            if self.inboxes.get(transfer_id) is inbox:
+                del self.inboxes[transfer_id]
+            if receiver is not None:
+                await self.io(receiver.close)
+    
+    def close(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+
+class ClientTransfer:
+    __slots__ = ('transfer_id', 'kind', 'local_path', 'remote_path', 'sender', 'receiver', 'done')
+    
+    def __init__(self, transfer_id, kind, local_path, remote_path):
+        self.transfer_id = transfer_id
+        self.kind = kind
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.sender = None
+        self.receiver = None
+        self.done = 0
+
+class TransferClient:
+    # Client side of the file channel; its own thread keeps disk I/O away from frames and input
+    def __init__(self, send, release, on_progress, window=WINDOW):
+        self.send = send  # send(message, payload=None, bulk=False)
+        self.release = release
+        self.on_progress = on_progress  # on_progress(transfer, text)
+        self.window = window
+        self.events = queue.Queue()
+        self.transfers = {}
+        self.ids = itertools.count(1)
+        threading.Thread(target=self.run, daemon=True).start()
+    
+    def download(self, remote_path, local_path):
+        self.events.put(('start', ClientTransfer(next(self.ids), 'download', local_path, remote_path)))
+    
+    def upload(self, local_path, remote_path):
+        self.events.put(('start', ClientTransfer(next(self.ids), 'upload', local_path, remote_path)))
+    
+    def dispatch(self, message, payload=None):
+        self.events.put(('message', message, payload))
+    
+    def resume(self):
+        # After a reconnect, unfinished transfers pick up from their last verified offset
+        self.events.put(('resume',))
+    
+    def interrupt(self):
+        self.events.put(('interrupt',))
+    
+    def run(self):
+        while True:
+            event = self.events.get()
+            try:
+                if event[0] == 'start':
+                    self.transfers[event[1].transfer_id] = event[1]
+                    self.request(event[1])
+                elif event[0] == 'message':
+                    self.handle(event[1], event[2])
+                elif event[0] == 'resume':
+                    for transfer in self.transfers.values():
+                        self.request(transfer)
+                elif event[0] == 'interrupt':
+                    for transfer in self.transfers.values():
+                        self.close(transfer)
+            except Exception as e:
+                print(f"Error transferring file: {e}")
+    
+    def request(self, transfer):
+        self.close(transfer)
+        if transfer.kind == 'download':
+            self.send({'type': 'download', 'id': transfer.transfer_id, 'path': transfer.remote_path})
+        else:
+            transfer.sender = ChunkSender.open(transfer.transfer_id, transfer.local_path, self.window)
+            fingerprint = transfer.sender.fingerprint()
+            self.send(dict(fingerprint, type='upload', id=transfer.transfer_id, path=transfer.remote_path))
+    
+    def close(self, transfer):
+        if transfer.sender is not None:
+            transfer.sender.close()
+            transfer.sender = None
+        if transfer.receiver is not None:
+            transfer.receiver.close()
+            transfer.receiver = None
+    
+    def finish(self, transfer, text):
+        self.close(transfer)
+        del self.transfers[transfer.transfer_id]
+        self.on_progress(transfer, text)
+    
+    def report(self, transfer, offset, size):
+        # One update per percent is plenty for a status bar
+        percent = offset * 100 // max(size, 1)
+        if percent != transfer.done:
+            transfer.done = percent
+            self.on_progress(transfer, f"{transfer.kind} {transfer.remote_path}: {percent}%")
+    
+    def handle(self, message, payload):
+        transfer = self.transfers.get(message['id'])
+        try:
+            if transfer is None:
+                return
+            
+            if message['type'] == 'file_error':
+                self.finish(transfer, f"{transfer.kind} {transfer.remote_path} failed: {message['error']}")
+            elif message['type'] == 'file_info':
+                fingerprint = {'size': message['size'], 'mtime': message['mtime']}
+                transfer.receiver = ChunkReceiver.open(transfer.transfer_id, transfer.local_path, fingerprint)
+                self.send(transfer.receiver.ack())
+                self.complete_download(transfer)
+            elif message['type'] == 'file_chunk' and transfer.receiver is not None:
+                ack = transfer.receiver.receive(message, payload)
+                if ack is not None:
+                    self.send(ack)
+                self.report(transfer, transfer.receiver.offset, transfer.receiver.size)
+                self.complete_download(transfer)
+            elif message['type'] == 'file_ack' and transfer.sender is not None:
+                sender = transfer.sender
+                sender.ack(message)
+                while sender.ready():
+                    chunk, data = sender.next_chunk()
+                    self.send(chunk, data, bulk=True)
+                self.report(transfer, sender.acked, sender.size)
+            elif message['type'] == 'file_done':
+                self.finish(transfer, f"Uploaded {transfer.local_path} to {transfer.remote_path}")
+        finally:
+            if payload is not None:
+                self.release(payload)
+    
+    def complete_download(self, transfer):
+        if transfer.receiver.complete:
+            transfer.receiver.finish()
+            transfer.receiver = None
+            self.finish(transfer, f"Downloaded {transfer.remote_path} to {transfer.local_path}")
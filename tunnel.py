@@ -0,0 +1,78 @@
+import json
+import subprocess
+import threading
+import time
+import urllib.request
+
+NGROK_API = "http://localhost:4040/api/tunnels"
+
+def find_tunnel(tunnels, port):
+    # Prefer the tcp tunnel forwarding to our port, another agent's tunnel is only a fallback
+    tcp = [tunnel for tunnel in tunnels if tunnel.get('proto') == 'tcp']
+    for tunnel in tcp:
+        if str(tunnel.get('config', {}).get('addr', '')).endswith(f":{port}"):
+            return tunnel['public_url']
+    return tcp[0]['public_url'] if tcp else None
+
+class NgrokTunnel:
+    # Starts ngrok and polls its local API on a background thread, so the server accepts local
+    # connections straight away; polling backs off and gives up after a deadline
+    def __init__(self, port, api_url=NGROK_API, command=('ngrok', 'tcp'), timeout=30.0,
+                 interval=0.25, max_interval=2.0, request_timeout=2.0, on_url=None, on_error=None):
+        self.port = port
+        self.api_url = api_url
+        self.command = command  # None to only watch an agent that is already running
+        self.timeout = timeout
+        self.interval = interval
+        self.max_interval = max_interval
+        self.request_timeout = request_timeout
+        self.on_url = on_url or (lambda url: None)
+        self.on_error = on_error or (lambda text: None)
+        self.process = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.url = None
+    
+    def start(self):
+        self.stopped.clear()
+        if self.command:
+            self.process = subprocess.Popen([*self.command, str(self.port)], stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.DEVNULL)
+        self.thread = threading.Thread(target=self.poll, daemon=True)
+        self.thread.start()
+    
+    def fetch(self):
+        with urllib.request.urlopen(self.api_url, timeout=self.request_timeout) as response:
+            return find_tunnel(json.load(response).get('tunnels', []), self.port)
+    
+    def poll(self):
+        deadline = time.monotonic() + self.timeout
+        interval = self.interval
+        error = "no tcp tunnel reported"
+        process = self.process
+        while not self.stopped.is_set():
+            if process is not None and process.poll() is not None:
+                self.on_error(f"ngrok exited with code {process.returncode}")
+                return
+            try:
+                url = self.fetch()
+                if url and not self.stopped.is_set():
+                    self.url = url
+                    self.on_url(url)
+                    return
+            except Exception as e:
+                error = str(e)  # The agent's API is not up yet
+            
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.on_error(f"No tunnel after {self.timeout:g}s: {error}")
+                return
+            self.stopped.wait(min(interval, remaining))
+            interval = min(interval * 2, self.max_interval)
+    
+    def stop(self):
+        self.stopped.set()
+        if self.process is not None:
+            self.process.terminate()
+            self.process = None
+        self.url = None